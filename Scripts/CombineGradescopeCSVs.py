@@ -1,11 +1,28 @@
 import os
+import re
 import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from bullet import Bullet       # pip install bullet
 
 # This script reads in all of the Gradescope data from all of the csv's in the cwd except 'allGrades.csv,'
-#   then combines these data into a single csv containing all of the grades, 'allGrades.csv' The script 
+#   then combines these data into a single csv containing all of the grades, 'allGrades.csv' The script
 #   also calculates a total grade for each experiment that has a graded report.
+#
+#   The csv's are read at the same time and every grade in them is stacked into one long list (a row per
+#     student per column), so they are combined in a single pass, rather than merging them into the roster one
+#     at a time, which gets slower with every file. For each student and column, the first value found in the
+#     roster then the files (in the order of glob) is kept.
+
+OUTPUT_FILE = 'allGrades.csv'
+
+# The Gradescope csv's have a bunch of columns that are not useful to us. We avoid loading that
+#   info using the info in sub_strings and usecols
+SUB_STRINGS = ['Submission', 'Max', 'Lateness','First Name', 'Last Name', 'SID', 'section_name']
+
+# The experiment number at the start of a column name, e.g. 'Exp3' in 'Exp3_Kinetics_Report'
+EXP_PATTERN = re.compile(r'Exp(\d+)(?!\d)')
 
 def setColumnOrder(allHeaders):
     firstHeaders = ['Last_Name', 'First_Name', 'SID']
@@ -15,63 +32,86 @@ def setColumnOrder(allHeaders):
     return newHeaders
 
 def main():
-    
+
     cwd = os.getcwd()
 
     # Get roster from main file
-    files = glob.glob("*.csv") 
+    files = glob.glob("*.csv")
     cli = Bullet("Choose main file", files, margin=3)
     rosterFile = cli.launch()
-     
-    # The main file is used to read first name, last name, and SID. All files are indexed by
-    #   Email, as this is the only info that is constant across our Gradescope courses.
-    roster = pd.read_csv(
-        os.path.join(os.getcwd(), rosterFile),
-        converters={"Email": str.lower},
-        usecols=["First Name", "Last Name", "SID", "Email"],
-        index_col="Email",
-    )
-
-    all_files = glob.glob(os.path.join(cwd, "*.csv")) 
-    oldOutput = glob.glob(os.path.join(cwd, "allGrades.csv"))
+
+    all_files = glob.glob(os.path.join(cwd, "*.csv"))
+    oldOutput = os.path.join(cwd, OUTPUT_FILE)
     if oldOutput in all_files:
         all_files.remove(oldOutput)
 
-    # The Gradescope csv's have a bunch of columns that are not useful to us. We avoid loading that
-    #   info using the info in sub_strings and usecols
-    sub_strings = ['Submission', 'Max', 'Lateness','First Name', 'Last Name', 'SID', 'section_name']
-    usecols = lambda x: not any(s in x for s in sub_strings)
-
-    for filename in all_files:
-        newDf = pd.read_csv(filename,
-                            converters={"Email": str.lower},
-                            usecols = usecols,
-                            index_col='Email'
-                            )
-        roster = roster.combine_first(newDf)
-    
+    roster = combineGrades(os.path.join(cwd, rosterFile), all_files)
+    roster.to_csv(OUTPUT_FILE, index=True)
+
+def combineGrades(rosterFile, gradeFiles):
+    """Combines the grades in gradeFiles with the names and SIDs in rosterFile, adding the experiment totals.
+       Returns a dataframe indexed by Email, with columns in the order of setColumnOrder."""
+
+    # The main file is used to read first name, last name, and SID. All files are indexed by
+    #   Email, as this is the only info that is constant across our Gradescope courses.
+    roster = readGrades(rosterFile, usecols=["First Name", "Last Name", "SID", "Email"])
+
+    # Read the files at once
+    usecols = lambda x: not any(s in x for s in SUB_STRINGS)
+    with ThreadPoolExecutor() as pool:
+        frames = [roster] + list(pool.map(lambda filename: readGrades(filename, usecols), gradeFiles))
+
+    # Stack every value into one list with its Email and column, keep the first value that is there for each
+    #   student and column, and spread them back out. Each file only has a few columns, so this is much less
+    #   work than lining every file up with every column.
+    emailCodes, emails = pd.factorize(np.concatenate([np.repeat(df.index.to_numpy(), df.shape[1]) for df in frames]))
+    columnCodes, columns = pd.factorize(np.concatenate([np.tile(df.columns.to_numpy(), len(df)) for df in frames]))
+    values = np.concatenate([df.to_numpy(dtype=object).ravel() for df in frames])
+    cells = emailCodes * len(columns) + columnCodes
+    present = pd.notna(values) & (emailCodes >= 0)      # Rows without an Email (code -1) belong to no one
+    cells, firsts = np.unique(cells[present], return_index=True)
+    grid = np.full((len(emails), len(columns)), np.nan, dtype=object)
+    grid.flat[cells] = values[present][firsts]
+    roster = pd.DataFrame(grid, index=pd.Index(emails, name='Email'), columns=columns).infer_objects().sort_index()
+
     # Clean up the column names, replacing spaces with _ and removing :
     roster.columns = roster.columns.str.replace(' ', '_')
     roster.columns = roster.columns.str.replace(':', '')
 
-    # Loop through the experiments. If all 3 pieces of the expt have Gradescope records, combine them
-    #   In doing this, skip any students w/o a report grade, but consider missing prelabs/notebooks as 0
-    #   The script assumes the exp parts have names 'ExpN: blahblah_Notebook', 'ExpN: blahblah_Prelab',
-    #   and 'ExpN: blahblah_Report' where N is an integer. 
     roster = roster[setColumnOrder(list(roster.columns))]    # Set column order
-    allHeaders = list(roster.columns)
-    for i in range(1, 9):  # There are only 7 labs, but this might be used elsewhere   
-        expPrefix = 'Exp' + str(i)
-        expParts = [x for x in allHeaders if x.startswith(expPrefix)]
-        if len(expParts) > 2:
-            expTotal = expParts[0].replace('_Notebook','') + '_Total'
-            roster[expTotal] = roster[expParts[0]].fillna(0) + roster[expParts[1]].fillna(0) + roster[expParts[2]]
-    
+    roster = pd.concat([roster, experimentTotals(roster)], axis=1)
+
     # Reorder the columns one more time because of the new lab totals.
-    roster = roster[setColumnOrder(list(roster.columns))]    # Set column order
-     
-    roster.to_csv("allGrades.csv", index=True)
+    return roster[setColumnOrder(list(roster.columns))]
+
+def readGrades(filename, usecols):
+    """Reads the columns in usecols of a Gradescope csv, indexed by lowercase Email."""
+    df = pd.read_csv(filename, usecols=usecols)
+    df['Email'] = df['Email'].str.lower()
+    return df.set_index('Email')
+
+def experimentTotals(roster):
+    """Totals of the experiments that have all 3 pieces in Gradescope, in one go.
+
+    In doing this, skip any students w/o a report grade, but consider missing prelabs/notebooks as 0.
+    The columns must be in alphabetical order, and the exp parts must have names 'ExpN blahblah_Notebook',
+    'ExpN blahblah_Prelab', and 'ExpN blahblah_Report' where N is an integer.
+    """
+    parts = {}
+    for col in roster.columns:
+        match = EXP_PATTERN.match(col)
+        if match:
+            parts.setdefault(int(match.group(1)), []).append(col)
+    experiments = [parts[n][:3] for n in sorted(parts) if len(parts[n]) > 2]
+    if len(experiments) == 0:
+        return pd.DataFrame(index=roster.index)
+
+    # One array of students x experiments x (notebook, prelab, report)
+    values = roster[[col for exp in experiments for col in exp]].to_numpy(dtype=float)
+    values = values.reshape(len(roster), len(experiments), 3)
+    totals = np.nan_to_num(values[:, :, 0]) + np.nan_to_num(values[:, :, 1]) + values[:, :, 2]
+    totalNames = [exp[0].replace('_Notebook','') + '_Total' for exp in experiments]
+    return pd.DataFrame(totals, index=roster.index, columns=totalNames)
 
 if __name__ == '__main__':
     main()
-
@@ -1,6 +1,7 @@
 import os
 import glob
 import pandas as pd
+from gradescopeCSV import read_evaluations
 
 def main():
     
@@ -11,17 +12,11 @@ def main():
     os.chdir('/Users/mah/Downloads/CHEM2070_Unknown_Acid_Molar_Mass_Post-lab_Report')
     files = glob.glob("*.csv") 
     
-    columns = ["SID", "Score", "Grader"]
-    usecols = lambda x: (x in columns)
     merged = None
     for index, file in enumerate(files):
     
         print(file)
-        canvas = pd.read_csv(file,
-                             usecols = usecols,
-                             skipfooter=4,
-                             engine='python'
-                             )
+        canvas = read_evaluations(file)
         newCol = 'Score' + str(index)
         canvas.rename(columns={'Score': newCol}, inplace=True)
         newCol = 'Grader' + str(index)
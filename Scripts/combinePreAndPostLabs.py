@@ -1,4 +1,6 @@
 import glob
+import re
+import numpy as np
 import pandas as pd
 import warnings
 from bullet import Bullet       # pip install bullet
@@ -20,6 +22,17 @@ from bullet import Bullet       # pip install bullet
 #   Usage:
 #    (canvas) ~/Desktop $ python /Users/mah/Programming/CanvasMAH/Scripts/CombinePreandPostLabs.py 
 
+# Dates in the Canvas Late Report look like 'Oct 1, 2025 at 11:59:00 PM EDT'
+CANVAS_DATE = re.compile(r'([A-Z][a-z]{2})[a-z]*\.? (\d{1,2}), (\d{4}) at (\d{1,2}):(\d{2})(?::(\d{2}))? ?([AaPp])\.?[Mm]\.? ([A-Za-z]+)')
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+# Offsets from UTC, in hours, of the US time zone abbreviations
+US_TIME_ZONES = {'EST': -5, 'EDT': -4, 'CST': -6, 'CDT': -5, 'MST': -7, 'MDT': -6, 'PST': -8, 'PDT': -7,
+                 'AKST': -9, 'AKDT': -8, 'HST': -10, 'HDT': -9, 'AST': -4, 'ADT': -3, 'SST': -11, 'ChST': 10,
+                 'UTC': 0, 'GMT': 0}
+
 def main():
     
     # Silences warning from pandas about having 'EX' entries
@@ -58,12 +71,14 @@ def main():
     canvasLate.rename(columns={'Student ID': 'ID'}, inplace=True)
     canvasLate.rename(columns={'Assignment Name': 'Assignment_Name'}, inplace=True)
     
-    # We have a problem in that pandas does not like EDT. Try replacing EDT/EST with UTC offset
+    # pandas does not understand time zones like EDT, so the dates are parsed by parse_canvas_dates, in UTC
     columns = ['Due Date', 'Submitted Date']
     for col in columns:
-        canvasLate[col] = canvasLate[col].str.replace('EDT', '-0400')
-        canvasLate[col] = canvasLate[col].str.replace('EST', '-0500')
-        canvasLate[col] = pd.to_datetime(canvasLate[col], format='%b %d, %Y at %-I:%M:%S %p %z')
+        try:
+            canvasLate[col] = parse_canvas_dates(canvasLate[col])
+        except ValueError as err:
+            print(f'ERROR: {col} in {canvasLateFile}: {err}')
+            exit()
 
     # Calculate lateness in hours, then assign penalty. Give 10 min grace period as per Cynthia.
     # This assumes that all late reports get 15% off even if they are over 72 hrs late
@@ -102,67 +117,68 @@ def main():
     # Merge the gradescope and canvas dataframes
     merged = pd.merge(canvas, gradescope, on='SIS User ID', how='left')
     
-    # Make a list to reorder columns
-    columnOrder = ["Student", "ID", "SIS User ID", "SIS Login ID", "Section"]
-    columnsToBeDropped = []
+    # Find the pre- and post-lab of each lab in Gradescope
+    labs = []
+    pre_labs = []
+    post_labs = []
     for entry in filtered_canvas_list:  
-        columnOrder.append(entry)
         first_word = entry.split()[0]   # Assume the labs start with the same first word
         
         gs_entries = [item for item in filtered_gradescope_list if first_word in item]
-        columnOrder.extend(sorted(gs_entries))
-        columnsToBeDropped.extend(gs_entries)
-        
-        # Make a column for penalties
-        newColumnName = first_word + '_penalty'
-        merged[newColumnName] = 0.0
-        columnOrder.append(newColumnName)
-        columnsToBeDropped.append(newColumnName)
-        
-        # Make a column for testing
-        newColumnName = first_word + '_testing'
-        merged[newColumnName] = 0.0
-        columnOrder.append(newColumnName)
-        columnsToBeDropped.append(newColumnName)        
-
-    merged = merged.reindex(columns = columnOrder)
+        labs.append(first_word)
+        pre_labs.append([item for item in gs_entries if 'pre-lab' in item.lower()][0])
+        post_labs.append([item for item in gs_entries if 'pre-lab' not in item.lower()][0])
     
-    # Now we need to transfer late lab penalties into merged
-    for row in canvasLate.itertuples():
-        if row.Penalty < 0:
-            labForPenalty = row.Assignment_Name.split()[0] + '_penalty'
-            merged.loc[merged['ID'] == row.ID, labForPenalty] = 0.01 * row.Penalty * 90
+    # Now we need to transfer late lab penalties into merged. Pivot the late submissions into a table of
+    #   students x labs, lined up with the rows of merged. A student who was late with both the pre- and
+    #   post-lab gets the penalty once. Late assignments that are not labs are ignored.
+    late = canvasLate[canvasLate['Penalty'] < 0].copy()
+    late['Lab'] = late['Assignment_Name'].str.split().str[0]
+    late = late[late['Lab'].isin(labs)]
+    penalties = late.pivot_table(index='ID', columns='Lab', values='Penalty', aggfunc='min')
+    penalties = 0.01 * penalties.reindex(index=merged['ID'], columns=labs).fillna(0).to_numpy() * 90
     
-    # Here is the actual calculation
-    for entry in filtered_canvas_list:  
-        first_word = entry.split()[0]   # Assume the labs start with the same first word
-        
-        gs_entries = [item for item in filtered_gradescope_list if first_word in item]
-        pre_lab = [item for item in gs_entries if 'pre-lab' in item.lower()]
-        post_lab = [item for item in gs_entries if 'pre-lab' not in item.lower()]
-        penaltyColumnName = first_word + '_penalty'
-        testingColumnName = first_word + '_testing'
-        
-        merged[testingColumnName] = merged[pre_lab[0]] + merged[post_lab[0]] + merged[penaltyColumnName]
-        merged[testingColumnName] = merged[testingColumnName].clip(lower=0)     # No negative grades
-        
+    # Here is the actual calculation, for all of the labs at once
+    totals = merged[pre_labs].to_numpy(dtype=float) + merged[post_labs].to_numpy(dtype=float) + penalties
+    totals = totals.clip(min=0)     # No negative grades
         
     # For debugging
-    # merged.to_csv('/Users/mah/Desktop/debugging.csv', index=False)
+    # pd.DataFrame(totals, columns=labs).to_csv('/Users/mah/Desktop/debugging.csv', index=False)
 
-    # Copy the calculation into the output column
-    for entry in filtered_canvas_list:  
-        first_word = entry.split()[0]   # Assume the labs start with the same first word
-        testingColumnName = first_word + '_testing'
-        merged.loc[merged[entry] != 'EX', entry] = merged[testingColumnName]
-        merged[entry] = merged[testingColumnName]
-         
-    # Remove all of the unnecessary columns
-    merged.drop(columns = columnsToBeDropped, inplace = True)
+    # Copy the calculation into the output columns and remove all of the unnecessary columns
+    merged = merged[["Student", "ID", "SIS User ID", "SIS Login ID", "Section"] + filtered_canvas_list].copy()
+    merged[filtered_canvas_list] = totals
     
     merged.to_csv('/Users/mah/Desktop/LabGrades.csv', index=False)
                              
 
+def parse_canvas_dates(dates):
+    """Parses a column of dates from the Canvas Late Report (see CANVAS_DATE), e.g. 'Oct 01, 2025 at 11:59:00 PM EDT',
+       into UTC datetimes. Missing dates become NaT. Raises ValueError, listing them, if any dates cannot be
+       parsed or have a time zone not in US_TIME_ZONES, as those students would otherwise get no late penalty.
+
+    Due dates repeat for every student, so each different string is only parsed once and the results are
+    copied back to the rows that have it. The strings are split up with a single regex over all of them.
+    """
+    codes, uniques = pd.factorize(dates)
+    parts = pd.Series(uniques, dtype=object).str.extract(CANVAS_DATE)
+    hour = pd.to_numeric(parts[3]) % 12 + np.where(parts[6].str.upper() == 'P', 12, 0)
+    local = pd.to_datetime(pd.DataFrame({'year': pd.to_numeric(parts[2]),
+                                         'month': parts[0].map(MONTHS),
+                                         'day': pd.to_numeric(parts[1]),
+                                         'hour': hour,
+                                         'minute': pd.to_numeric(parts[4]),
+                                         'second': pd.to_numeric(parts[5]).fillna(0)}), errors='coerce')
+    utc = local - pd.to_timedelta(parts[7].map(US_TIME_ZONES), unit='h')
+    failed = [date for date, parsed in zip(uniques, utc) if pd.isna(parsed)]
+    if len(failed) > 0:
+        raise ValueError(f'Could not read {len(failed)} dates: ' + ', '.join(repr(date) for date in failed[:10])
+                         + (', …' if len(failed) > 10 else ''))
+
+    # Code -1 (a missing date) picks the NaT added at the end
+    utc = np.append(utc.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT'))
+    return pd.Series(utc[codes], index=dates.index, name=dates.name).dt.tz_localize('UTC')
+
 if __name__ == '__main__':
 
 
@@ -0,0 +1,614 @@
+# Usage: python gradescopeAnalysis.py semesterFolder [--out GraderReports] [--workers 4]
+#
+# Analysis of the grading in a folder of Gradescope scores made by "Export Evaluations", shared by
+#   analyzeGradescopeFolder.py and multifileAnalysis.py. There is one csv per problem.
+#
+#   Run as a script, it analyzes every Export Evaluations folder under semesterFolder, one assignment per
+#     worker process, so a whole semester's grading can be audited at once. For each assignment, outFolder
+#     gets a folder (named after the assignment's folder) with the same csv's the streamlit apps download:
+#     AllData.csv, AllGraderData.csv, PrimaryGraderAnalysis.csv, ProblemAnalysis.csv with the analysis by
+#     grader of each problem, GraderBias.csv (see grader_bias) and RubricAnalysis.csv (see rubric_usage).
+#     outFolder also gets CombinedPrimaryGraderAnalysis.csv, CombinedProblemAnalysis.csv and
+#     CombinedGraderBias.csv, which stack these for all of the assignments.
+#
+#   All of the csv's are read into one long dataframe with a row per student per problem, and everything
+#     else is worked out from that in one go, rather than merging in one problem at a time.
+#
+#   Dataframes produced in the analysis
+#   combo_df            This contains all of the data: the total, primary grader, and each problem's score and grader
+#   comboGrader_df      This contains the mean, std dev and count for each grader on each problem
+#   primaryGrader_df    This contains the analysis of the total by primary grader
+#   bias_df             This contains each grader's offset, raw and adjusted for the students and problems graded
+#   The primary grader is defined to be the grader who grades the most parts of the problem
+#
+#   The analysis by grader of each problem is worked out at the same time, from the same grouped statistics
+#     as comboGrader_df, and returned in a dictionary with primaryGrader_df, so switching between problems
+#     needs no further work.
+#
+#   rubric_usage works out how often each grader applied each rubric item, and whether that is significantly
+#     different from the other graders, so it shows which items a lenient (or harsh) grader skips. The rubric
+#     items are read into a sparse submission x item matrix and all of the counts for a problem come from a
+#     single sparse matrix product, so thousands of submissions and hundreds of items take a fraction of a second.
+#     The script writes this to RubricAnalysis.csv for each assignment.
+#
+#   Each analysis by grader also has the difference of each grader's mean from the mean of all graders, with a
+#     95% bootstrap confidence interval, and marks the graders whose interval does not include zero (see
+#     grader_differences). This shows whether a grader who only graded a few papers is really different.
+#
+#   Raw grader means mix up how lenient a grader is with which students and problems they happened to get.
+#     grader_bias fits every score as (student ability) + (problem difficulty) + (grader offset), for all of
+#     the problems at once, so the grader offsets are adjusted for both. The fit is a sparse least squares
+#     problem (a column per student, problem and grader) solved with scipy's lsqr, which takes well under a
+#     second for thousands of students, dozens of problems and tens of graders.
+#
+#   A ResultCache keeps analyses keyed by a hash of the files they came from (see files_key), so the same
+#     export is only analyzed once.
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+from scipy.special import ndtr
+from gradescopeCSV import read_evaluations, read_rubric, read_bytes, problem_name, is_evaluations_csv, compact_dtypes
+
+# Number of bootstrap resamples for the confidence intervals of the grader differences, and the seed of the
+#   random numbers, so the same export always gives the same intervals
+BOOTSTRAP_RESAMPLES = 1000
+BOOTSTRAP_SEED = 0
+
+# Most random numbers drawn at once in the bootstrap. Bigger is a little faster but takes more memory.
+BOOTSTRAP_BATCH = 2_000_000
+
+# Significance level of the rubric item tests, before the Bonferroni correction for the number of tests
+RUBRIC_ALPHA = 0.05
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Analyze the grading in every Gradescope Export Evaluations folder in a tree')
+    parser.add_argument('semesterFolder', type = str, help = 'Folder containing the Export Evaluations folders')
+    parser.add_argument('--out', type = str, default = 'GraderReports', help = 'Folder for the reports')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'Number of assignments analyzed at once')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.semesterFolder):
+        print(f'ERROR: {args.semesterFolder} is not a valid directory.')
+        exit()
+
+    assignments = find_assignments(args.semesterFolder)
+    if len(assignments) == 0:
+        print(f'ERROR: There are no Export Evaluations csv\'s in {args.semesterFolder}.')
+        exit()
+
+    analyze_assignments(assignments, args.out, max(args.workers, 1))
+
+def find_assignments(rootFolder):
+    """Returns {assignment: [csv's]} for every folder under rootFolder that holds Export Evaluations csv's. The
+       assignment is the folder's path relative to rootFolder, and the csv's are in problem number order."""
+    assignments = {}
+    for folder, subFolders, fileNames in os.walk(rootFolder):
+        subFolders.sort()
+        files = [os.path.join(folder, fn) for fn in fileNames if fn.endswith('.csv')]
+        files = [fn for fn in files if is_evaluations_csv(fn)]
+        if len(files) > 0:
+            assignment = os.path.relpath(folder, rootFolder)
+            assignments[os.path.basename(os.path.abspath(rootFolder)) if assignment == '.' else assignment] = sorted(files, key = natural_key)
+    return assignments
+
+def natural_key(path):
+    """Sorts 2_Problem.csv before 10_Problem.csv"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', os.path.basename(path))]
+
+def analyze_assignments(assignments, outFolder, numWorkers):
+    """Analyzes each assignment in its own process and writes the reports to outFolder (see the top of this file)."""
+    primaryReports = []
+    problemReports = []
+    biasReports = []
+    with ProcessPoolExecutor(max_workers = numWorkers) as pool:
+        futures = {pool.submit(write_assignment_reports, assignment, files, os.path.join(outFolder, assignment)): assignment
+                   for assignment, files in assignments.items()}
+        for future in as_completed(futures):
+            assignment = futures[future]
+            try:
+                primary_df, problem_df, bias_df = future.result()
+            except Exception as err:
+                print(f'ERROR: Could not analyze {assignment}: {err}')
+                continue
+            print(f'Analyzed {assignment}.')
+            primaryReports.append(primary_df.assign(Assignment = assignment))
+            problemReports.append(problem_df.assign(Assignment = assignment))
+            biasReports.append(bias_df.assign(Assignment = assignment))
+
+    # Stack the reports in assignment order, with the assignment first
+    if len(primaryReports) > 0:
+        for reports, fileName in ((primaryReports, 'CombinedPrimaryGraderAnalysis.csv'), (problemReports, 'CombinedProblemAnalysis.csv'),
+                                  (biasReports, 'CombinedGraderBias.csv')):
+            combined = pd.concat(reports).reset_index()
+            combined = combined[['Assignment'] + [col for col in combined.columns if col != 'Assignment']]
+            combined = combined.sort_values('Assignment', kind = 'stable')
+            combined.to_csv(os.path.join(outFolder, fileName), index = False)
+
+def write_assignment_reports(assignment, files, outFolder):
+    """Analyzes one assignment and writes its reports to outFolder. Runs in a worker process. Returns primaryGrader_df,
+       the analysis by grader of each problem, stacked, and bias_df for the combined reports."""
+    combo_df, comboGrader_df, summaries, bias_df, probNameList = analyze_files(files)
+    problem_df = problem_table(summaries, probNameList)
+
+    os.makedirs(outFolder, exist_ok = True)
+    combo_df.to_csv(os.path.join(outFolder, 'AllData.csv'))
+    comboGrader_df.to_csv(os.path.join(outFolder, 'AllGraderData.csv'))
+    summaries[' All'].to_csv(os.path.join(outFolder, 'PrimaryGraderAnalysis.csv'))
+    problem_df.to_csv(os.path.join(outFolder, 'ProblemAnalysis.csv'))
+    bias_df.to_csv(os.path.join(outFolder, 'GraderBias.csv'))
+    rubric_usage(files).to_csv(os.path.join(outFolder, 'RubricAnalysis.csv'), index = False)
+    return summaries[' All'].rename_axis('Grader'), problem_df, bias_df
+
+def problem_table(summaries, probNameList):
+    """Stacks the analysis by grader of each problem into one dataframe indexed by Problem and Grader."""
+    tables = [summaries[p].rename_axis('Grader') for p in probNameList[1:]]
+    return pd.concat(tables, keys = probNameList[1:], names = ['Problem'])
+
+def analyze_files(files):
+    """Reads and analyzes the csv's of an Export Evaluations, in the order given. Returns
+       (combo_df, comboGrader_df, summaries, bias_df, probNameList) as for analyze."""
+    return analyze(read_problems(files))
+
+def files_key(files):
+    """A hash of the names and contents of files (paths or files uploaded to streamlit), in order. The names are
+       included because they name the problems."""
+    digest = hashlib.sha256()
+    for source in files:
+        data = read_bytes(source)
+        digest.update(problem_name(source).encode() + b'\0' + str(len(data)).encode() + b'\0')
+        digest.update(data)
+    return digest.hexdigest()
+
+class ResultCache:
+    """A least recently used cache of analyses that holds at most maxBytes of results.
+
+    Results are shared with everyone who asks for the same key, so they must not be changed. The cache can be
+    used from several threads (e.g. streamlit sessions) at once.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self._entries = OrderedDict()      # key: (result, bytes), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the result for key, or None if it is not in the cache."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, result):
+        """Adds a result, evicting the least recently used ones until it fits. Results bigger than the whole
+           cache are not kept."""
+        size = result_bytes(result)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            if size > self.maxBytes:
+                return
+            while self.bytes + size > self.maxBytes:
+                self.bytes -= self._entries.popitem(last = False)[1][1]
+            self._entries[key] = (result, size)
+            self.bytes += size
+
+    def get_or_compute(self, key, compute):
+        """Returns the result for key, calling compute() and caching what it returns if need be."""
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+def result_bytes(result):
+    """Roughly how much memory a result takes: the deep size of any dataframes in it, and the size of any
+       plotly figures as json, which is close to the data they hold (plotly is not needed to measure them)."""
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(deep = True).sum())
+    if isinstance(result, pd.Series):
+        return int(result.memory_usage(deep = True))
+    if isinstance(result, dict):
+        return sum(result_bytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(result_bytes(value) for value in result)
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if callable(getattr(result, 'to_json', None)):
+        return len(result.to_json())
+    return sys.getsizeof(result)
+
+def read_problems(files):
+    """Reads the csv's of an Export Evaluations into one dataframe with columns SID, Problem, Score and Grader.
+       Problem is a category in the order of files."""
+    frames = []
+    for source in files:
+        gs_df = read_evaluations(source)
+        gs_df['Problem'] = problem_name(source)
+        frames.append(gs_df)
+
+    # Give every problem the same grader categories so the graders stay a category when the problems are joined
+    graders = union_categoricals([gs_df['Grader'] for gs_df in frames], sort_categories = True)
+    long_df = pd.concat(frames, ignore_index = True)
+    long_df['Grader'] = graders
+    long_df['Problem'] = pd.Categorical(long_df['Problem'], categories = [gs_df['Problem'].iloc[0] for gs_df in frames])
+    return long_df
+
+def analyze(long_df):
+    """Analyzes a dataframe made by read_problems. Returns (combo_df, comboGrader_df, summaries, bias_df, probNameList).
+       probNameList is ' All' then the problems in alphabetical order, as in the problem menu. summaries maps each
+       name in it to its analysis by grader: ' All' to primaryGrader_df and each problem to the mean, std dev and
+       count of its scores for all graders and for each grader. bias_df is from grader_bias."""
+    problems = list(long_df['Problem'].cat.categories)
+    stats = grader_stats(long_df)
+    combo_df = combine_students(long_df, problems)
+    comboGrader_df = combine_graders(stats, problems)
+    summaries = {' All': summarize_by_grader(combo_df, 'Total', 'Primary Grader')}
+    summaries[' All'] = add_differences(summaries[' All'], grader_differences(combo_df, 'Total', 'Primary Grader'))
+    summaries.update(problem_summaries(stats, problems, grader_differences(long_df, 'Score', 'Grader', 'Problem')))
+
+    # The statistics are all worked out in float64, so only now are the scores stored in float32
+    combo_df = compact_dtypes(combo_df, list(long_df['Grader'].cat.categories))
+    return combo_df, comboGrader_df, summaries, grader_bias(long_df), [' All'] + sorted(problems)
+
+def combine_students(long_df, problems):
+    """Returns combo_df, with a row for each student in the first problem and columns Total, Primary Grader, SID,
+       then Score_ and Grader_ for each problem."""
+
+    # Students are matched across problems by SID. Students with a blank (or repeated) SID are matched by their
+    #   order among the rows with that SID, so each of them keeps a row of their own.
+    sidCodes = pd.factorize(long_df['SID'], use_na_sentinel = False)[0]
+    occurrence = long_df.groupby([long_df['Problem'].to_numpy(), sidCodes], observed = True).cumcount().to_numpy()
+    keyed_df = pd.DataFrame({'student': sidCodes, 'occurrence': occurrence, 'Problem': long_df['Problem'].to_numpy(),
+                             'Score': long_df['Score'].to_numpy(), 'Grader': long_df['Grader'].to_numpy()})
+
+    # One row per student, with a column for each problem's score and grader
+    wide = keyed_df.set_index(['student', 'occurrence', 'Problem']).unstack('Problem')
+
+    # Students who are not in the first problem are left out, as Gradescope lists everyone in every problem
+    first = (long_df['Problem'] == problems[0]).to_numpy()
+    sids = long_df.loc[first, 'SID']
+    wide = wide.reindex(pd.MultiIndex.from_arrays([sidCodes[first], occurrence[first]]))
+
+    scores = pd.DataFrame({'Score_' + p: wide[('Score', p)].to_numpy() for p in problems})
+    graders = pd.DataFrame({'Grader_' + p: wide[('Grader', p)].to_numpy() for p in problems})
+
+    columns = {'Total': scores.sum(axis = 1, skipna = False),     # Missing scores give a missing total
+               'Primary Grader': primary_grader(graders),
+               'SID': sids.to_numpy()}
+    for p in problems:
+        columns['Score_' + p] = scores['Score_' + p]
+        columns['Grader_' + p] = graders['Grader_' + p]
+    return pd.DataFrame(columns)
+
+def primary_grader(graders):
+    """Returns the grader who appears most often in each row of graders (a dataframe of grader names), or NaN
+       if a row has no graders. Ties go to the grader who comes first alphabetically, as with mode(axis = 1)[0].
+
+    The names are turned into integer codes (in alphabetical order) once, and the graders in every row are
+    counted in a single bincount, so this takes milliseconds for thousands of students and dozens of problems.
+    """
+    numRows = len(graders)
+    codes, names = pd.factorize(graders.to_numpy(dtype = object).ravel(), sort = True)
+    if len(names) == 0:
+        return pd.Series(np.nan, index = graders.index, dtype = object)
+    numNames = len(names) + 1      # Code -1 (no grader) is counted in column 0 and then ignored
+
+    # counts[row, code + 1] is the number of problems in row graded by grader code
+    rowStarts = (np.arange(numRows) * numNames)[:, np.newaxis]
+    cells = (rowStarts + codes.reshape(numRows, -1) + 1).ravel()
+    counts = np.bincount(cells, minlength = numRows * numNames).reshape(numRows, numNames)[:, 1:]
+
+    # argmax returns the first of equal counts, i.e. the alphabetically first grader
+    primary = pd.Series(np.asarray(names, dtype = object)[counts.argmax(axis = 1)], index = graders.index)
+    return primary.where(counts.max(axis = 1) > 0)
+
+def grader_stats(long_df):
+    """Returns the mean, std and count of the scores of every problem for all graders (All) and for each grader.
+       The rows are the graders and the columns are (statistic, problem)."""
+
+    # Summarize every problem by grader, and every problem as a whole, in one pass each. Scores stored in
+    #   float32 are summarized in float64, so the published statistics are not rounded.
+    long_df = long_df.astype({'Score': 'float64'})
+    byGrader = long_df.groupby(['Problem', 'Grader'], observed = True)['Score'].agg(['mean', 'std', 'count'])
+    byProblem = long_df.groupby('Problem', observed = True)['Score'].agg(['mean', 'std', 'count'])
+    byProblem['Grader'] = 'All'
+    byProblem = byProblem.set_index('Grader', append = True)
+    stats = pd.concat([byProblem, byGrader]).unstack('Problem')
+
+    graders = ['All'] + [grader for grader in long_df['Grader'].cat.categories if grader in stats.index]
+    stats = stats.reindex(graders)
+    stats.index.name = 'Grader'
+    return stats
+
+def combine_graders(stats, problems):
+    """Returns comboGrader_df, with a row for all graders (All) and for each grader, and columns mean (the sum of the
+       means of the problems) then mean_, std dev_ and count_ for each problem."""
+    columns = {}
+    for p in problems:
+        columns['mean_' + p] = stats[('mean', p)]
+        columns['std dev_' + p] = stats[('std', p)]
+        columns['count_' + p] = stats[('count', p)]
+    comboGrader_df = pd.DataFrame(columns)
+    comboGrader_df.insert(0, 'mean', comboGrader_df[['mean_' + p for p in problems]].sum(axis = 1, skipna = False))
+    return comboGrader_df
+
+def problem_summaries(stats, problems, differences):
+    """Returns {problem: analysis by grader}, like summarize_by_grader on the problem's Score_ and Grader_ columns,
+       with the differences of each grader from grader_differences (indexed by problem and grader)."""
+    summaries = {}
+    for p in problems:
+        summary = pd.DataFrame({'mean': stats[('mean', p)], 'std dev': stats[('std', p)], 'count': stats[('count', p)]})
+        summary = summary[summary['count'].notna()]     # Graders who did not grade this problem
+        summary['count'] = summary['count'].astype(int)
+        summary = add_differences(summary, differences.xs(p, level = 'Problem') if p in differences.index.get_level_values('Problem') else None)
+        summary.index.name = 'Grader_' + p
+        summaries[p] = summary
+    return summaries
+
+def add_differences(summary, differences):
+    """Adds the columns of grader_differences to an analysis by grader. The All row has a difference of 0."""
+    columns = ['difference', '95% CI low', '95% CI high', 'significant']
+    if differences is None:
+        differences = pd.DataFrame(columns = columns)
+    summary = summary.join(differences[columns])
+    summary.loc['All', 'difference'] = 0.0
+    summary['significant'] = summary['significant'].fillna(False).astype(bool)
+    return summary
+
+def grader_differences(df, scoreCol, graderCol, poolCol = None):
+    """Returns the difference of each grader's mean score from the mean of all of the graded scores, with a 95%
+       bootstrap confidence interval. With poolCol (e.g. Problem), graders are compared within each value of it.
+
+    Returns a dataframe indexed by grader (or by poolCol and grader) with columns difference, 95% CI low,
+    95% CI high and significant, which is True if the interval does not include zero. A grader with a single
+    score has no interval.
+    """
+    df = df[df[scoreCol].notna() & df[graderCol].notna()]
+    keys = [poolCol, graderCol] if poolCol else [graderCol]
+    grouped = df.groupby(keys, observed = True, sort = True)[scoreCol]
+    index = grouped.size().index
+    groups = grouped.ngroup().to_numpy()
+    pools = pd.factorize(index.get_level_values(poolCol))[0] if poolCol else np.zeros(len(index), dtype = np.int64)
+
+    difference, low, high = bootstrap_differences(df[scoreCol].to_numpy(dtype = float), groups, pools)
+    return pd.DataFrame({'difference': difference, '95% CI low': low, '95% CI high': high,
+                         'significant': (low > 0) | (high < 0)}, index = index)
+
+def bootstrap_differences(scores, groups, pools, numResamples = BOOTSTRAP_RESAMPLES, seed = BOOTSTRAP_SEED):
+    """For each group of scores, the difference of its mean from the mean of its pool of groups, and the 2.5 and
+       97.5 percentiles of the difference over bootstrap resamples. groups is the group of each score, numbered
+       from 0, and pools is the pool of each group. Returns (difference, low, high), arrays with one per group.
+
+    Each resample redraws every group's scores, with replacement, from that group, and the pool means are worked
+    out from the redrawn groups. All of the groups, and a batch of resamples, are drawn at once.
+    """
+    numGroups = len(pools)
+    if numGroups == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+    counts = np.bincount(groups, minlength = numGroups)
+
+    # poolShare[g, pool] is group g's share of the scores in its pool, so group means @ poolShare are the pool means
+    poolShare = np.zeros((numGroups, pools.max(initial = -1) + 1))
+    poolShare[np.arange(numGroups), pools] = counts / np.bincount(pools, weights = counts)[pools]
+
+    means = np.bincount(groups, weights = scores, minlength = numGroups) / counts
+    difference = means - (means @ poolShare)[pools]
+
+    # Scores on a problem usually take only a handful of values, and then it is much faster to draw how many
+    #   times each value comes up than to draw every score. A binomial draw costs about 10 uniform draws.
+    rng = np.random.default_rng(seed)
+    values, frequencies = score_values(scores, groups, numGroups)
+    if 10 * values.size < len(scores):
+        resampled = resample_values(values, frequencies, counts, numResamples, rng)
+    else:
+        resampled = resample_scores(scores, groups, counts, numResamples, rng)
+    resampled -= (resampled @ poolShare)[:, pools]
+
+    low, high = np.percentile(resampled, [2.5, 97.5], axis = 0)
+    single = counts < 2
+    low[single] = np.nan
+    high[single] = np.nan
+    return difference, low, high
+
+def score_values(scores, groups, numGroups):
+    """Returns (values, frequencies): row g of values holds the different scores in group g, and frequencies how
+       many times each comes up. Rows are padded with zero frequencies."""
+    order = np.lexsort((scores, groups))
+    scores, groups = scores[order], groups[order]
+    isNew = np.ones(len(scores), dtype = bool)
+    isNew[1:] = (groups[1:] != groups[:-1]) | (scores[1:] != scores[:-1])
+    pair = np.cumsum(isNew) - 1                  # Number of each (group, score) pair
+    pairGroups = groups[isNew]
+    firstPair = np.searchsorted(pairGroups, np.arange(numGroups))
+    column = np.arange(len(pairGroups)) - firstPair[pairGroups]
+
+    values = np.zeros((numGroups, column.max(initial = -1) + 1))
+    frequencies = np.zeros(values.shape, dtype = np.int64)
+    values[pairGroups, column] = scores[isNew]
+    frequencies[pairGroups, column] = np.bincount(pair)
+    return values, frequencies
+
+def resample_values(values, frequencies, counts, numResamples, rng):
+    """Bootstrap means of each group from score_values, drawing how often each value comes up in each resample."""
+    probabilities = frequencies / counts[:, np.newaxis]
+    resampled = np.empty((numResamples, len(counts)))
+    perBatch = max(1, BOOTSTRAP_BATCH // max(values.size, 1))
+    for first in range(0, numResamples, perBatch):
+        draws = rng.multinomial(counts, probabilities, size = (min(perBatch, numResamples - first), len(counts)))
+        resampled[first:first + len(draws)] = (draws * values).sum(axis = 2) / counts
+    return resampled
+
+def resample_scores(scores, groups, counts, numResamples, rng):
+    """Bootstrap means of each group, drawing every score of every resample."""
+    order = np.argsort(groups, kind = 'stable')
+    scores, groups = scores[order], groups[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # A random 32-bit integer times the size of the score's group, divided by 2**32, is an (almost exactly)
+    #   uniform position in the group
+    scoreStarts = starts[groups]
+    scoreCounts = counts[groups].astype(np.uint64)
+    resampled = np.empty((numResamples, len(counts)))
+    perBatch = max(1, BOOTSTRAP_BATCH // max(len(scores), 1))
+    for first in range(0, numResamples, perBatch):
+        draws = rng.integers(0, 2**32, size = (min(perBatch, numResamples - first), len(scores)), dtype = np.uint32)
+        picks = (draws * scoreCounts >> np.uint64(32)).astype(np.int64) + scoreStarts
+        resampled[first:first + len(draws)] = np.add.reduceat(scores[picks], starts, axis = 1) / counts
+    return resampled
+
+def grader_bias(long_df):
+    """Estimates how many points each grader gives above or below the average, allowing for the students and
+       problems they graded. long_df is from read_problems.
+
+    Every graded score is modeled as overall mean + student + problem + grader. The student, problem and
+    grader effects each sum to zero, the grader effects weighted by how many scores each grader gave, so a
+    grader's Adjusted Offset is the points per problem they give above the average grader for the same
+    student on the same problem. Raw Offset is the plain average of (score - problem mean) over the grader's
+    scores, for comparison. If a grader's students or problems were graded by no one else, the two cannot be
+    told apart and the Adjusted Offset is not meaningful.
+
+    Returns a dataframe indexed by Grader with columns Scores, Raw Offset and Adjusted Offset.
+    """
+    df = long_df[long_df['Score'].notna() & long_df['Grader'].notna()]
+    students, studentNames = pd.factorize(df['SID'])
+    problems, problemNames = pd.factorize(df['Problem'])
+    graders, graderNames = pd.factorize(df['Grader'].astype(object), sort = True)
+
+    # A score with a blank SID (code -1) cannot be matched to the student's other scores, so it is given a
+    #   student of its own rather than being counted in the overall mean's column
+    blank = students < 0
+    students[blank] = len(studentNames) + np.arange(blank.sum())
+    numScores, numStudents, numProblems, numGraders = len(df), len(studentNames) + blank.sum(), len(problemNames), len(graderNames)
+    scores = df['Score'].to_numpy(dtype = float)
+    counts = np.bincount(graders, minlength = numGraders)
+    if numScores == 0:
+        return pd.DataFrame({'Scores': counts, 'Raw Offset': np.nan, 'Adjusted Offset': np.nan},
+                            index = pd.Index(graderNames, name = 'Grader'))
+
+    # Columns: overall mean, then an effect for each student, problem and grader. Each score's row has a 1 in its
+    #   overall mean, student, problem and grader columns.
+    problemStart = 1 + numStudents
+    graderStart = problemStart + numProblems
+    numCols = graderStart + numGraders
+    rows = np.repeat(np.arange(numScores), 4)
+    cols = np.column_stack([np.zeros(numScores, dtype = np.int64), 1 + students, problemStart + problems, graderStart + graders]).ravel()
+    A = sparse.csr_matrix((np.ones(4 * numScores), (rows, cols)), shape = (numScores, numCols))
+
+    # The sum-to-zero constraints, one row each, which pin down the effects without changing the fit
+    constraintCols = [np.arange(1, problemStart), np.arange(problemStart, graderStart), np.arange(graderStart, numCols)]
+    constraintValues = [np.ones(numStudents), np.ones(numProblems), counts / numScores]
+    C = sparse.csr_matrix((np.concatenate(constraintValues),
+                           (np.repeat(np.arange(3), [len(c) for c in constraintCols]), np.concatenate(constraintCols))),
+                          shape = (3, numCols))
+    weight = np.sqrt(numScores)     # Weight the constraints so they hold even for big exports
+    A = sparse.vstack([A, weight * C]).tocsr()
+    b = np.concatenate([scores, np.zeros(3)])
+
+    effects = lsqr(A, b, atol = 1e-10, btol = 1e-10, iter_lim = 10 * numCols)[0]
+
+    problemMeans = np.bincount(problems, weights = scores) / np.bincount(problems)
+    rawOffset = np.bincount(graders, weights = scores - problemMeans[problems], minlength = numGraders) / counts
+    return pd.DataFrame({'Scores': counts, 'Raw Offset': rawOffset, 'Adjusted Offset': effects[graderStart:]},
+                        index = pd.Index(graderNames, name = 'Grader'))
+
+def rubric_usage(files):
+    """Returns how often each grader applied each rubric item of each problem in files, with a row per problem,
+       item and grader. See rubric_usage_table for the columns."""
+    tables = []
+    for source in files:
+        gs_df, items, X = read_rubric(source)
+        table = rubric_usage_table(gs_df['Grader'], items, X)
+        table.insert(0, 'Problem', problem_name(source))
+        tables.append(table)
+    return compact_dtypes(pd.concat(tables, ignore_index = True))
+
+def rubric_usage_table(graders, items, X):
+    """Compares how often each grader applied each rubric item with the other graders. graders is the grader of each
+       submission, items the names of the rubric items and X the sparse submission x item matrix from read_rubric.
+
+    Returns a dataframe with a row per item and grader: Uses (submissions the grader applied the item to),
+    Submissions (submissions the grader graded), Rate (Uses / Submissions), Pooled Rate (for all graders),
+    Difference (Rate - Pooled Rate), and z and p-value from a two-proportion z-test of the grader against the
+    other graders. Significant marks p-values below RUBRIC_ALPHA divided by the number of tests (Bonferroni),
+    so about 1 in 20 problems will have a false alarm however many items and graders there are.
+    Ungraded submissions are left out.
+    """
+    graded = graders.notna().to_numpy()
+    codes, names = pd.factorize(graders[graded], sort = True)
+    X = X[graded]
+    numSubs, numGraders = len(codes), len(names)
+
+    # uses[g, j] is the number of grader g's submissions with item j, from one sparse product
+    G = sparse.csr_matrix((np.ones(numSubs, dtype = np.int32), (np.arange(numSubs), codes)), shape = (numSubs, numGraders))
+    uses = (G.T @ X.astype(np.int32)).toarray()
+    subs = np.bincount(codes, minlength = numGraders)[:, np.newaxis]
+    totalUses = uses.sum(axis = 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rate = uses / subs
+        pooled = np.broadcast_to(totalUses / numSubs, rate.shape)
+        otherRate = (totalUses - uses) / (numSubs - subs)
+        se = np.sqrt(pooled * (1 - pooled) * (1 / subs + 1 / (numSubs - subs)))
+        z = (rate - otherRate) / se
+
+    # No spread (an item everyone or no one applied) or no other graders is no evidence of a difference
+    z = np.where(np.isfinite(z), z, 0)
+    pValue = 2 * ndtr(-np.abs(z))
+    numTests = max(numGraders * len(items), 1)
+
+    return pd.DataFrame({'Rubric Item': np.tile(np.asarray(items, dtype = object), numGraders),
+                         'Grader': np.repeat(np.asarray(names, dtype = object), len(items)),
+                         'Uses': uses.ravel(),
+                         'Submissions': np.repeat(subs.ravel(), len(items)),
+                         'Rate': rate.ravel(),
+                         'Pooled Rate': pooled.ravel(),
+                         'Difference': (rate - pooled).ravel(),
+                         'z': z.ravel(),
+                         'p-value': pValue.ravel(),
+                         'Significant': pValue.ravel() < RUBRIC_ALPHA / numTests})
+
+def summarize_by_grader(df, scoreCol, graderCol):
+    """Analyzes a dataframe of grades to produce statistical analysis by grader. Returns a new dataframe. """
+
+    # Perform the analysis by grader, in float64 even if the scores are stored in float32
+    df = df[[scoreCol, graderCol]].astype({scoreCol: 'float64'})
+    new_df = df.groupby(graderCol, observed = True).describe()
+
+    # Get rid of the multilevel column headers
+    new_df.columns = new_df.columns.droplevel(level=0)
+
+    # Perform an analysis of all of the grades. This will appear as the grader " All"
+    all_df = df[[scoreCol]].describe()
+    all_df = all_df.T
+    all_df.rename(index={scoreCol: 'All'}, inplace=True)
+    all_df.index.name = graderCol
+
+    # Combine the ' All' data with the grader data
+    new_df = pd.concat([all_df, new_df])
+
+    # Get rid of extranous columns, then reorder
+    cols_to_drop = ['min', '25%', '50%', '75%', 'max']
+    new_df = new_df.drop(columns = cols_to_drop)
+    newOrder = ['mean', 'std', 'count']
+    new_df = new_df[newOrder]
+    new_df = new_df.rename(columns={'std': 'std dev'})
+    new_df['count'] = new_df['count'].astype(int)
+
+    return new_df
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# Fast reader for the csv's made by Gradescope's "Export Evaluations", shared by analyzeGradescopeFolder.py,
+#   multifileAnalysis.py and combineGradescopeParts.py.
+#
+#   Each csv has one row per student followed by a footer of 4 lines (Point Values, Rubric Numbers, etc.)
+#     that pandas cannot parse. pandas' skipfooter only works with its slow pure-Python parser, so instead we
+#     cut the footer off the raw bytes and hand the rest to the fast C parser. (pyarrow's parser is not used
+#     because it cannot read the comments, which often contain line breaks.)
+#
+#   Only the columns we use are kept, Grader as a category, which stores each grader's name once instead of
+#     once per student, and SID as an integer. Score stays float64, so the statistics worked out from it are
+#     exact; the tables that are kept afterwards store it as float32 (see compact_dtypes).
+#
+#   compact_dtypes gives the dataframes made from these csv's (e.g. combo_df in gradescopeAnalysis.py) the same
+#     compact types: every grader column a category with the same grader names, every score float32, SID an
+#     integer, and other repetitive text (e.g. problem names) a category. These are a fraction of the size of
+#     object strings and float64, which matters when many streamlit sessions share a small server. The
+#     statistics are worked out before the tables are compacted, so they are computed in float64.
+#     memory_report shows the memory used before and after.
+#
+#   The csv also has a true/false column for each rubric item, saying whether the item was applied to each
+#     submission. read_rubric reads these into a sparse matrix, which only stores the items that were applied.
+#     The rubric items are the columns with a number in the footer's Rubric Numbers row, so other true/false
+#     columns (e.g. whether a submission was graded) are not mistaken for them.
+
+import csv
+import io
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Number of lines at the end of the csv that are not student data
+FOOTER_LINES = 4
+
+COLUMNS = ['SID', 'Score', 'Grader']
+
+DTYPES = {'Grader': 'category'}
+
+def read_evaluations(source, columns = COLUMNS):
+    """Reads a csv made by Gradescope's Export Evaluations. source can be a path or a file uploaded to
+       streamlit. Returns a dataframe with the columns in columns that are in the csv."""
+    data = strip_footer(read_bytes(source))
+
+    # Find which of the columns are there, so a missing one does not stop the read
+    header = next(csv.reader(io.StringIO(data.split(b'\n', 1)[0].decode('utf-8-sig'))), [])
+    usecols = [col for col in header if col in columns]
+
+    df = pd.read_csv(io.BytesIO(data), usecols = usecols)
+    df = df.astype({col: dtype for col, dtype in DTYPES.items() if col in df.columns})
+    if 'SID' in df.columns:
+        df['SID'] = compact_sids(df['SID'])
+    return df
+
+def compact_dtypes(df, graders = None):
+    """Returns a copy of df with compact column types:
+         Grader, Primary Grader and Grader_ columns      a category, all with the same categories: graders, or
+                                                         every name in these columns in alphabetical order
+         Score, Total, mean, std dev and their _ columns float32
+         SID                                             an integer (see compact_sids)
+         other text repeated in at least half the rows   a category
+    """
+    df = df.copy()
+    graderCols = [col for col in df.columns if is_grader_column(col)]
+    if graderCols:
+        if graders is None:
+            graders = sorted(set().union(*[column_values(df[col]) for col in graderCols]))
+        graderType = pd.CategoricalDtype(graders)
+        for col in graderCols:
+            df[col] = df[col].astype(object).astype(graderType)
+
+    for col in df.columns:
+        if col in graderCols:
+            continue
+        column = df[col]
+        if col == 'SID':
+            df[col] = compact_sids(column)
+        elif is_score_column(col) and pd.api.types.is_float_dtype(column.dtype):
+            df[col] = column.astype('float32')
+        elif (pd.api.types.is_string_dtype(column.dtype) or column.dtype == object) and not isinstance(column.dtype, pd.CategoricalDtype):
+            if column.map(type, na_action = 'ignore').isin([str]).all() and column.nunique() <= len(column) // 2:
+                df[col] = column.astype('category')
+    return df
+
+def compact_sids(sids):
+    """SIDs as integers (nullable Int64 if some are missing) if they are all whole numbers, otherwise unchanged."""
+    numbers = pd.to_numeric(sids, errors = 'coerce')
+    if numbers.isna().sum() > sids.isna().sum() or len(sids) == 0:
+        return sids
+    known = numbers.dropna()
+    if not (known == known.round()).all():
+        return sids
+    return numbers.astype('int64' if len(known) == len(numbers) else 'Int64')
+
+def is_grader_column(col):
+    """Whether a column of an analysis holds grader names."""
+    return col in ('Grader', 'Primary Grader') or str(col).startswith('Grader_')
+
+def is_score_column(col):
+    """Whether a column of an analysis holds scores or statistics of scores."""
+    return str(col).split('_')[0] in ('Score', 'Total', 'mean', 'std dev')
+
+def column_values(column):
+    """The different values in a column, without blanks."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return set(column.cat.categories)
+    return set(column.dropna())
+
+def memory_report(frames):
+    """Returns the memory used by each of frames ({name: dataframe}), in MB, as it is (Compact MB) and as it
+       would be with text as Python strings and numbers in 64 bits (Plain MB), the types pandas reads by default."""
+    report = {}
+    for name, df in frames.items():
+        plain = df.astype({col: plain_dtype(df[col].dtype) for col in df.columns})
+        report[name] = {'Plain MB': deep_bytes(plain) / 1e6, 'Compact MB': deep_bytes(df) / 1e6}
+    report = pd.DataFrame.from_dict(report, orient = 'index')
+    report.loc['Total'] = report.sum()
+    report['Saved'] = 1 - report['Compact MB'] / report['Plain MB']
+    return report
+
+def plain_dtype(dtype):
+    """The type pandas would use by default for a column of type dtype."""
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float64'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'float64' if pd.api.types.is_extension_array_dtype(dtype) else 'int64'
+    if pd.api.types.is_bool_dtype(dtype):
+        return dtype
+    return object
+
+def deep_bytes(df):
+    """Memory used by df, including its index and the strings in it."""
+    return int(df.memory_usage(deep = True).sum())
+
+def read_rubric(source):
+    """Reads the rubric items of a csv made by Gradescope's Export Evaluations. Returns (gs_df, items, X): gs_df has
+       the SID and Grader of each submission, items is the names of the rubric items, and X is a sparse boolean
+       matrix with X[i, j] True if rubric item j was applied to submission i."""
+    data = read_bytes(source)
+    end = footer_start(data)
+    df = pd.read_csv(io.BytesIO(data[:end]))
+
+    # The rubric items are the columns numbered in the footer's Rubric Numbers row. The row is lined up with the
+    #   header from the right, as the rubric items are the last columns. Without that row, fall back on the
+    #   columns with nothing but true and false in them.
+    numbers = footer_row(data[end:], 'Rubric Numbers')
+    if numbers is not None:
+        offset = len(df.columns) - len(numbers)
+        items = [df.columns[i + offset] for i, number in enumerate(numbers)
+                 if i > 0 and 0 <= i + offset < len(df.columns) and number.strip() != '']
+    else:
+        items = [col for col in df.columns if col not in COLUMNS and is_bool_column(df[col])]
+    X = sparse.csr_matrix(df[items].fillna(False).to_numpy(dtype = bool))
+
+    gs_df = df[[col for col in ['SID', 'Grader'] if col in df.columns]].astype({'Grader': 'category'})
+    return gs_df, items, X
+
+def is_bool_column(column):
+    """Whether a column holds only true/false values (and blanks). pandas reads these as bool, or as objects
+       if there are blanks."""
+    if column.dtype == bool:
+        return True
+    if column.dtype != object:
+        return False
+    values = column.dropna()
+    return len(values) > 0 and values.map(lambda value: isinstance(value, (bool, np.bool_))).all()
+
+def is_evaluations_csv(path):
+    """Whether the csv at path looks like it was made by Export Evaluations, i.e. has SID, Score and Grader columns."""
+    with open(path, 'r', newline = '', encoding = 'utf-8-sig', errors = 'replace') as csvFile:
+        header = next(csv.reader(csvFile), [])
+    return all(col in header for col in COLUMNS)
+
+def read_bytes(source):
+    """Returns the contents of a path or of a file uploaded to streamlit."""
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    with open(source, 'rb') as csvFile:
+        return csvFile.read()
+
+def strip_footer(data):
+    """Cuts the last FOOTER_LINES lines off the bytes of an Export Evaluations csv, as skipfooter would."""
+    return data[:footer_start(data)]
+
+def footer_start(data):
+    """Where the last FOOTER_LINES lines of the bytes of an Export Evaluations csv start. The footer is found by
+       searching back from the end, so the rest of the file is not copied line by line."""
+    end = len(data.rstrip(b'\r\n'))
+    for i in range(FOOTER_LINES):
+        end = data.rfind(b'\n', 0, end)
+    return end + 1
+
+def footer_row(footer, name):
+    """The cells of the row of footer (the bytes after footer_start) that starts with name, e.g. 'Rubric Numbers',
+       or None if there is no such row."""
+    for row in csv.reader(io.StringIO(footer.decode('utf-8', errors = 'replace'))):
+        if len(row) > 0 and row[0] == name:
+            return row
+    return None
+
+def problem_name(source):
+    """The name of the problem in a csv: its file name without .csv"""
+    return os.path.basename(getattr(source, 'name', source)).removesuffix('.csv')
@@ -0,0 +1,186 @@
+# Usage: python gradingHistory.py ingest historyFolder exportFolder --term Fall2025 --course CHEM2070
+#        python gradingHistory.py trends historyFolder [--term Fall2025 ...] [--course CHEM2070 ...] [--grader Name ...]
+#                                        [--out GraderTrends.csv]
+#
+# Keeps the scores from Gradescope's "Export Evaluations" in a history, so a TA's grading can be compared
+#   across assignments and semesters without uploading dozens of folders to analyzeGradescopeFolder.py.
+#
+#   ingest reads every Export Evaluations folder under exportFolder (see gradescopeAnalysis.find_assignments)
+#     and adds it to historyFolder, a Parquet dataset partitioned by term, course and assignment:
+#       historyFolder/Term=Fall2025/Course=CHEM2070/Assignment=Lab1/<hash>.parquet
+#     with a row per student per problem (SID, Problem, Score, Grader, ExportHash). The file is named by a
+#     hash of the export's contents (see gradescopeAnalysis.files_key), so ingesting the same export again
+#     does nothing, even under another term, course or assignment name. A new export of an assignment that
+#     is already in the history (e.g. after regrades) replaces the old one.
+#
+#   trends writes GraderTrends.csv, with the raw and bias-adjusted offset of each grader on each assignment
+#     (see gradescopeAnalysis.grader_bias), and prints each grader's average over the assignments. Only the
+#     partitions for the requested terms and courses are read, so a report on one course does not read the
+#     whole history. Every grader's scores are read, as the adjusted offsets need them all; --grader only
+#     picks which graders are reported.
+#
+#   read_history gives the same filtered access to the history for other scripts, and can also keep only some
+#     graders' rows as the files are read. The streamlit apps do not use the history; they analyze the files
+#     that are uploaded to them.
+#
+#   This requires the installation of pyarrow, e.g.
+#       pip install pyarrow
+
+import argparse
+import os
+import uuid
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from gradescopeAnalysis import find_assignments, files_key, read_problems, grader_bias
+
+PARTITIONS = ['Term', 'Course', 'Assignment']
+
+PARTITION_SCHEMA = pa.schema([(name, pa.string()) for name in PARTITIONS])
+
+# The schema of the files. SIDs are kept as strings, as they are not numbers in every course.
+SCHEMA = pa.schema([('SID', pa.string()),
+                    ('Problem', pa.string()),
+                    ('Score', pa.float32()),
+                    ('Grader', pa.dictionary(pa.int32(), pa.string())),
+                    ('ExportHash', pa.string())])
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Keep a history of Gradescope Export Evaluations and report on it')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    ingest = commands.add_parser('ingest', help = 'Add Export Evaluations folders to the history')
+    ingest.add_argument('historyFolder', type = str, help = 'Folder holding the history')
+    ingest.add_argument('exportFolder', type = str, help = 'Folder containing the Export Evaluations folders')
+    ingest.add_argument('--term', type = str, required = True, help = 'Term of the exports, e.g. Fall2025')
+    ingest.add_argument('--course', type = str, required = True, help = 'Course of the exports, e.g. CHEM2070')
+
+    trends = commands.add_parser('trends', help = 'Report each grader\'s offsets across assignments')
+    trends.add_argument('historyFolder', type = str, help = 'Folder holding the history')
+    trends.add_argument('--term', type = str, nargs = '+', help = 'Only these terms')
+    trends.add_argument('--course', type = str, nargs = '+', help = 'Only these courses')
+    trends.add_argument('--grader', type = str, nargs = '+', help = 'Only these graders')
+    trends.add_argument('--out', type = str, default = 'GraderTrends.csv', help = 'File for the report')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        if not os.path.isdir(args.exportFolder):
+            print(f'ERROR: {args.exportFolder} is not a valid directory.')
+            exit()
+        assignments = find_assignments(args.exportFolder)
+        if len(assignments) == 0:
+            print(f'ERROR: There are no Export Evaluations csv\'s in {args.exportFolder}.')
+            exit()
+        for assignment, files in assignments.items():
+            if ingest_export(args.historyFolder, args.term, args.course, assignment, files):
+                print(f'Added {assignment}.')
+            else:
+                print(f'{assignment} is already in the history.')
+
+    else:
+        if not os.path.isdir(args.historyFolder):
+            print(f'ERROR: {args.historyFolder} is not a valid directory.')
+            exit()
+        history_df = read_history(args.historyFolder, terms = args.term, courses = args.course)
+        if len(history_df) == 0:
+            print('ERROR: There are no scores in the history for these terms and courses.')
+            exit()
+        trends_df = grader_trends(history_df)
+        if args.grader:
+            trends_df = trends_df[trends_df['Grader'].isin(args.grader)]
+        trends_df.to_csv(args.out, index = False)
+        print(summarize_trends(trends_df).to_string())
+
+def ingest_export(historyFolder, term, course, assignment, files):
+    """Adds the csv's of one Export Evaluations to the history. Returns False, and does nothing, if the same
+       export is already anywhere in the history. Any other export of the same assignment is replaced."""
+    exportHash = files_key(files)
+    partition = partition_folder(historyFolder, term, course, assignment)
+    fileName = exportHash + '.parquet'
+    if export_files(historyFolder, fileName):
+        return False
+
+    long_df = read_problems(files)
+    export_df = pd.DataFrame({'SID': long_df['SID'].astype(str).where(long_df['SID'].notna()),
+                              'Problem': long_df['Problem'].astype(str),
+                              'Score': long_df['Score'],
+                              'Grader': long_df['Grader'],
+                              'ExportHash': exportHash})
+    table = pa.Table.from_pandas(export_df, schema = SCHEMA, preserve_index = False)
+
+    # Write to a scratch name that the dataset ignores, so a reader never sees half a file
+    os.makedirs(partition, exist_ok = True)
+    tmpPath = os.path.join(partition, f'_{uuid.uuid4().hex}.tmp')
+    pq.write_table(table, tmpPath)
+    os.replace(tmpPath, os.path.join(partition, fileName))
+    for oldName in os.listdir(partition):
+        if oldName.endswith('.parquet') and oldName != fileName:
+            os.remove(os.path.join(partition, oldName))
+    return True
+
+def export_files(historyFolder, fileName):
+    """The paths of the files called fileName in any partition of the history. Only the folder names are
+       read, not the files."""
+    if not os.path.isdir(historyFolder):
+        return []
+    return [os.path.join(folder, fileName) for folder, subFolders, fileNames in os.walk(historyFolder) if fileName in fileNames]
+
+def partition_folder(historyFolder, term, course, assignment):
+    """The folder of the history holding an assignment. The names are escaped as pyarrow expects, so an
+       assignment like Chem2070/Lab1 is one folder."""
+    values = [term, course, assignment]
+    return os.path.join(historyFolder, *[f'{name}={quote(value, safe = "")}' for name, value in zip(PARTITIONS, values)])
+
+def history_dataset(historyFolder):
+    """The history as a pyarrow dataset, with Term, Course and Assignment columns from the folder names."""
+    partitioning = ds.partitioning(PARTITION_SCHEMA, flavor = 'hive')
+    return ds.dataset(historyFolder, format = 'parquet', partitioning = partitioning, schema = pa.unify_schemas([SCHEMA, PARTITION_SCHEMA]),
+                      exclude_invalid_files = False, ignore_prefixes = ['.', '_'])
+
+def read_history(historyFolder, terms = None, courses = None, assignments = None, graders = None, columns = None):
+    """Reads scores from the history into a dataframe, keeping only the given terms, courses, assignments and
+       graders (all of them if None), and only the given columns (all if None).
+
+    The filters on Term, Course and Assignment skip whole folders without opening them, and the filter on
+    Grader is applied as each file is read. Grader and the partition columns are categories.
+    """
+    conditions = [ds.field(name).isin(list(values))
+                  for name, values in (('Term', terms), ('Course', courses), ('Assignment', assignments), ('Grader', graders))
+                  if values is not None]
+    condition = None
+    for next_condition in conditions:
+        condition = next_condition if condition is None else condition & next_condition
+
+    table = history_dataset(historyFolder).to_table(columns = columns, filter = condition)
+    df = table.to_pandas()
+    for col in PARTITIONS + ['Grader']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def grader_trends(history_df):
+    """Returns the Scores, Raw Offset and Adjusted Offset of each grader on each assignment in a dataframe from
+       read_history (see gradescopeAnalysis.grader_bias), with a row per term, course, assignment and grader."""
+    reports = []
+    for (term, course, assignment), assignment_df in history_df.groupby(PARTITIONS, observed = True):
+        bias_df = grader_bias(assignment_df[['SID', 'Problem', 'Score', 'Grader']])
+        reports.append(bias_df.reset_index().assign(Term = term, Course = course, Assignment = assignment))
+    trends_df = pd.concat(reports, ignore_index = True)
+    trends_df = trends_df[PARTITIONS + ['Grader', 'Scores', 'Raw Offset', 'Adjusted Offset']]
+    return trends_df.sort_values(PARTITIONS + ['Grader'], ignore_index = True)
+
+def summarize_trends(trends_df):
+    """Each grader's number of assignments and scores, and offsets averaged over their scores."""
+    weights = trends_df['Scores']
+    summary = trends_df.assign(rawPoints = trends_df['Raw Offset'] * weights, adjustedPoints = trends_df['Adjusted Offset'] * weights)
+    summary = summary.groupby('Grader').agg(Assignments = ('Assignment', 'size'), Scores = ('Scores', 'sum'),
+                                            rawPoints = ('rawPoints', 'sum'), adjustedPoints = ('adjustedPoints', 'sum'))
+    summary['Raw Offset'] = summary.pop('rawPoints') / summary['Scores']
+    summary['Adjusted Offset'] = summary.pop('adjustedPoints') / summary['Scores']
+    return summary.sort_values('Adjusted Offset')
+
+if __name__ == '__main__':
+    main()
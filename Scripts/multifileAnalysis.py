@@ -1,8 +1,7 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import numpy as np
 import streamlit.components.v1 as components
+from gradescopeCSV import memory_report
+from streamlitHelpers import cached_analysis, cached_rubric_usage, download_buttons, paged_table
 
 # This is a streamlit package that is designed primarily to analyze a folder of Gradescope
 #   scores for an assignment. To get the folder, open the assignment in Gradescope and select
@@ -15,90 +14,6 @@ import streamlit.components.v1 as components
 #   Usage: streamlit run multifileAnalysis.py
 
 
-def read_gradescope_csv(file_str):
-
-    # The Gradescope csv's have a bunch of columns that are not useful to us. We avoid loading them
-    columns = ['SID', 'Score', 'Grader']
-    usecols = lambda x: (x in columns)
-
-    gs_df = pd.read_csv(file_str,
-                        usecols = usecols,
-                        skipfooter=4,   # Skips crap at end of file
-                        engine='python'
-                        )
-                        
-    # Now summarize by grader
-    grader_df = summarize_by_grader(gs_df, 'Score', 'Grader')
-    
-    # Need to give the Score and Grade columns unique names for this file
-    problemName = file_str.name.removesuffix('.csv')
-    # problemName = file_str.removesuffix('.csv')
-    
-    columnsToRename = ['Score', 'Grader']
-    gsRenamedColumns = []
-    for oldName in columnsToRename:
-        newName = oldName + '_' + problemName
-        gs_df.rename(columns={oldName: newName}, inplace=True)
-        gsRenamedColumns.append(newName)
-    
-    columnsToRename = ['mean', 'std dev', 'count']
-    graderRenamedColumns = []
-    for oldName in columnsToRename:
-        newName = oldName + '_' + problemName
-        grader_df.rename(columns={oldName: newName}, inplace=True)
-        graderRenamedColumns.append(newName)
-
-    return problemName, gs_df, gsRenamedColumns, grader_df, graderRenamedColumns
-
-def summarize_by_grader(df, scoreCol, graderCol):
-
-    new_df = df[[scoreCol, graderCol]].groupby(graderCol).describe()
-    new_df.columns = new_df.columns.droplevel(level=0)    
-    # st.markdown(new_df.columns)
-    
-    # And all data
-    all_df = df[[scoreCol]].describe()
-    all_df = all_df.T
-    all_df.rename(index={scoreCol: 'All'}, inplace=True)
-    all_df.index.name = graderCol
-    
-    new_df = pd.concat([all_df, new_df])
-    # new_df = new_df.rename(columns={new_df.columns[0]: graderCol})
-    # st.markdown(new_df.columns)
-    
-    cols_to_drop = ['min', '25%', '50%', '75%', 'max']
-    new_df = new_df.drop(columns = cols_to_drop)
-    newOrder = ['mean', 'std', 'count']
-    new_df = new_df[newOrder]
-    new_df = new_df.rename(columns={'std': 'std dev'})
-     
-    return new_df
-    
-def prepare_graph(df):  # Create a bar chart with error bars
-    
-    plt_df = df.copy()
-    plt_df['Grader'] = plt_df.index
-    plt_df['sum_mean_sd'] = plt_df['mean'] + plt_df['std dev']
-    plt_df['diff_mean_sd'] = plt_df['mean'] - plt_df['std dev']
-    
-    # Now put in order of mean
-    df_header = plt_df.iloc[[0]]
-    df_rest = plt_df.iloc[1:]
-    df_rest = df_rest.sort_values(by='mean', ascending=True)
-    plt_df = pd.concat([df_header, df_rest])
-    fig = px.bar(
-        plt_df,
-        x='Grader',
-        y="mean",
-        error_y="std dev",
-        color_discrete_sequence=['darkkhaki'],
-        title="Mean and Std Dev by Grader"
-    )
-    fig.update_yaxes(range=[plt_df['diff_mean_sd'].min(), plt_df['sum_mean_sd'].max()])
-    fig.add_hline(y=plt_df['mean'].iloc[0], annotation_text="mean", 
-          line_dash="dot", line_color='black')
-    return fig
-
 @st.dialog('Enter string')
 def nameOfAnalysis_dialog():
     # st.write('Data being analyzed.')
@@ -144,19 +59,15 @@ def handle_upload_change():
 def handle_problem_change():
     # Function to update session state when the problem to be analyzed is changed
     
+    # The analysis and graph of every problem were made with the rest of the analysis, so just look them up
     if st.session_state['file_uploaded'] and st.session_state['analysis_done']:
-        if st.session_state.problem_select_box == ' All':
+        problem = st.session_state.problem_select_box
+        if problem == ' All':
             st.session_state['current_problem'] = 'Analysis of All Problems'
-            st.session_state.primaryGrader_df = summarize_by_grader(st.session_state.combo_df, 'Total','Primary Grader')
         else:
-            st.session_state['current_problem'] = 'Analysis of ' + st.session_state.problem_select_box
-            score_col = 'Score_' + st.session_state.problem_select_box
-            grader_col = 'Grader_' + st.session_state.problem_select_box
-            cols = ['SID', score_col, grader_col]
-            sub_df = st.session_state.combo_df[cols].copy()
-            st.session_state.primaryGrader_df = summarize_by_grader(sub_df, score_col, grader_col)
-       
-        st.session_state.fig = prepare_graph(st.session_state.primaryGrader_df)
+            st.session_state['current_problem'] = 'Analysis of ' + problem
+        st.session_state.primaryGrader_df = st.session_state.summaries[problem]
+        st.session_state.fig = st.session_state.figures[problem]
      
 def reset_uploader():
     """Function to clear the uploaded file and show the uploader again."""
@@ -183,59 +94,35 @@ else:
 
 allData = st.sidebar.checkbox('Show all data.', key = 3141)
 allGraderData = st.sidebar.checkbox('Show all grader data', key = 3142)
+biasData = st.sidebar.checkbox('Show bias-adjusted grader analysis', key = 3144)
+rubricData = st.sidebar.checkbox('Show rubric item analysis', key = 3143)
+memoryUse = st.sidebar.checkbox('Show memory use', key = 3145)
 
 if st.session_state['file_uploaded'] and not st.session_state['analysis_done']: # uploaded_files:
 
     nameOfAnalysis_dialog()
     
-    for uploaded_file in st.session_state['uploaded_file_data']:
-                
-        # Read a file and generate a number of dataframes
-        #   combo_df            This contains all of the data 
-        #   comboGrader_df      This contains all of the data by primary grader
-        #   primaryGrader_df    This contains the analysis by primary grader
-        # The primary grader is defined to be the grader who grades the most of the assignment
-        
-        probName, gs_df,gsCols, grader_df, graderCols = read_gradescope_csv(uploaded_file)
-        
-        if 'combo_df' in locals():
-            combo_df = pd.merge(combo_df, gs_df, on='SID', how='left')
-            combo_df['Total'] = combo_df['Total'] + combo_df[gsCols[0]]
-            graderNameCols.append(gsCols[1])
-            combo_df['Primary Grader'] = combo_df[graderNameCols].mode(axis=1)[0]
-            
-            comboGrader_df = pd.merge(comboGrader_df, grader_df, on='Grader', how='left')
-            comboGrader_df['mean'] = comboGrader_df['mean'] + comboGrader_df[graderCols[0]]
-            
-            primaryGrader_df = summarize_by_grader(combo_df, 'Total','Primary Grader')
-            
-            probNameList.append(probName)
-        else:
-            combo_df = gs_df
-            combo_df['Total'] = gs_df[gsCols[0]]
-            combo_df['Primary Grader'] = gs_df[gsCols[1]]
-            graderNameCols = [gsCols[1]]  # Columns containing grader names
-            cols = ['Total'] + ['Primary Grader'] + [col for col in combo_df.columns if col not in ['Total', 'Primary Grader']]
-            combo_df = combo_df[cols]   # Reorder columns
-            
-            comboGrader_df = grader_df
-            comboGrader_df['mean'] = grader_df[graderCols[0]]
-            cols = ['mean'] + [col for col in comboGrader_df.columns if col != 'mean']
-            comboGrader_df = comboGrader_df[cols] # Reorder columns
-            
-            primaryGrader_df = summarize_by_grader(combo_df, 'Total', 'Primary Grader')
-            
-            probNameList = [' All', probName]          
-            
-    st.session_state.probNameList = probNameList.sort()
+    # Read all of the files and generate a number of dataframes (see gradescopeAnalysis.py). Analyses are cached
+    #   by the contents of the files, so the same export is only analyzed once, whichever session uploads it.
+    #   combo_df            This contains all of the data 
+    #   comboGrader_df      This contains all of the data by primary grader
+    #   primaryGrader_df    This contains the analysis by primary grader
+    # The primary grader is defined to be the grader who grades the most of the assignment
+    # The analysis and graph of each problem are made at the same time, ready for the problem menu
+    combo_df, comboGrader_df, summaries, figures, bias_df, biasFig, probNameList = cached_analysis(st.session_state['uploaded_file_data'])
+    primaryGrader_df = summaries[' All']
     
-    st.session_state.fig = prepare_graph(primaryGrader_df)
+    st.session_state.fig = figures[' All']
     
     st.session_state.analysis_done = True
     st.session_state.combinedData = st.empty()
     st.session_state.combo_df = combo_df
     st.session_state.comboGrader_df = comboGrader_df
     st.session_state.primaryGrader_df = primaryGrader_df
+    st.session_state.summaries = summaries
+    st.session_state.figures = figures
+    st.session_state.bias_df = bias_df
+    st.session_state.biasFig = biasFig
     st.session_state.probNameList = probNameList
 
 if st.session_state['file_uploaded'] and st.session_state['analysis_done']:
@@ -246,31 +133,31 @@ if st.session_state['file_uploaded'] and st.session_state['analysis_done']:
         
         st.dataframe(st.session_state.primaryGrader_df)
 
-        st.download_button(
-            "Download Primary Grader Analysis",
-            st.session_state.primaryGrader_df.to_csv().encode("utf-8"),
-            'PrimaryGraderAnalysis.csv',
-            "text/csv",
-            key = 'primary_grader_download'
-        )
+        download_buttons(st.session_state.primaryGrader_df, 'Primary Grader Analysis', 'PrimaryGraderAnalysis', 'primary_grader_download')
         if allData:
-            st.dataframe(st.session_state.combo_df)
-            st.download_button(
-                "Download All Data",
-                st.session_state.combo_df.to_csv().encode("utf-8"),
-                'AllData.csv',
-                "text/csv",
-                key = 'all_data_download'
-            )
+            paged_table(st.session_state.combo_df, 'all_data_table')
+            download_buttons(st.session_state.combo_df, 'All Data', 'AllData', 'all_data_download')
         if allGraderData:
-            st.dataframe(st.session_state.comboGrader_df)
-            st.download_button(
-                "Download All Grader Data",
-                st.session_state.comboGrader_df.to_csv().encode("utf-8"),
-                'AllGraderData.csv',
-                "text/csv",
-                key = 'all_grader_data_download'
-            )
+            paged_table(st.session_state.comboGrader_df, 'all_grader_data_table')
+            download_buttons(st.session_state.comboGrader_df, 'All Grader Data', 'AllGraderData', 'all_grader_data_download')
+        if biasData:
+            # Each grader's offset, adjusted for the students and problems they graded (see gradescopeAnalysis.grader_bias)
+            st.plotly_chart(st.session_state.biasFig, width = 'stretch')
+            st.dataframe(st.session_state.bias_df)
+            download_buttons(st.session_state.bias_df, 'Grader Bias Analysis', 'GraderBias', 'bias_download')
+        if rubricData:
+            # How often each grader used each rubric item of the current problem (or of every problem), most
+            #   significant differences from the other graders first (see gradescopeAnalysis.rubric_usage)
+            rubricTables = cached_rubric_usage(st.session_state['uploaded_file_data'])
+            rubric_df = rubricTables.get(st.session_state.get('problem_select_box', ' All'), rubricTables[' All'].iloc[:0])
+            paged_table(rubric_df, 'rubric_table', hide_index = True)
+            download_buttons(rubric_df, 'Rubric Item Analysis', 'RubricAnalysis', 'rubric_download', index = False)
+        if memoryUse:
+            # Memory used by the analysis, and what it would be with pandas' default types (see gradescopeCSV.compact_dtypes)
+            st.dataframe(memory_report({'combo_df': st.session_state.combo_df,
+                                        'comboGrader_df': st.session_state.comboGrader_df,
+                                        'primaryGrader_df': st.session_state.primaryGrader_df,
+                                        'bias_df': st.session_state.bias_df}))
         
         selected_problem = st.sidebar.selectbox(
                             'Problem to be analyzed:',
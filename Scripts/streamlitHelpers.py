@@ -0,0 +1,220 @@
+# Streamlit pieces shared by analyzeGradescopeFolder.py and multifileAnalysis.py.
+#
+#   Streamlit reruns the whole app on every click, and each browser tab is a new session, so anything kept in
+#     st.session_state is lost on a new upload or in a new tab. Analyses are instead kept in one ResultCache
+#     (see gradescopeAnalysis.py) that every session shares, keyed by a hash of the uploaded files. Analyzing
+#     the same export again, in any tab, is then instant. The hash is worked out once per upload and kept in
+#     the session (see upload_key), so a rerun does not read every file again.
+#
+#   The graph for every problem is made when the analysis is, and cached with it, so picking a problem from
+#     the menu is just a lookup. So is the graph of the grader offsets (see gradescopeAnalysis.grader_bias).
+#
+#   The rubric item analysis is only made if it is asked for, and is cached in the same way.
+#
+#   Files for download are only made when "Prepare" is clicked (see download_buttons), in the chosen format
+#     (csv, Parquet or Excel), and kept in the session, so big tables are not written out on every rerun.
+#
+#   Big tables are shown a page at a time by paged_table. Sorting, filtering and picking columns are done here,
+#     and only the rows and columns on the page are sent to the browser.
+
+import io
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import streamlit as st
+from gradescopeAnalysis import ResultCache, analyze_files, files_key, rubric_usage
+
+# Most memory the cached analyses may take. The least recently used are dropped to stay under it.
+CACHE_MB = 512
+
+@st.cache_resource
+def result_cache():
+    """The cache shared by every session. st.cache_resource makes it once per server."""
+    return ResultCache(CACHE_MB * 1024 * 1024)
+
+def cached_analysis(files):
+    """Returns (combo_df, comboGrader_df, summaries, figures, bias_df, biasFig, probNameList), from the cache if the
+       same files have been analyzed before. See gradescopeAnalysis.analyze. figures maps each name in probNameList
+       to the graph of its summary, and biasFig is the graph of bias_df. Everything returned is shared with other
+       sessions, so it must not be changed."""
+
+    def analyze_and_graph():
+        combo_df, comboGrader_df, summaries, bias_df, probNameList = analyze_files(files)
+        figures = {name: prepare_graph(summary) for name, summary in summaries.items()}
+        return combo_df, comboGrader_df, summaries, figures, bias_df, prepare_bias_graph(bias_df), probNameList
+
+    return result_cache().get_or_compute(upload_key(files), analyze_and_graph)
+
+def upload_key(files):
+    """The files_key of the uploaded files, worked out once per upload and then kept in the session. An upload is
+       told apart by the file_id streamlit gives each uploaded file."""
+    fileIds = tuple(getattr(source, 'file_id', None) or id(source) for source in files)
+    saved = st.session_state.get('upload_key')
+    if saved is None or saved[0] != fileIds:
+        saved = (fileIds, files_key(files))
+        st.session_state['upload_key'] = saved
+    return saved[1]
+
+# Rows on each page of a paged_table
+PAGE_ROWS = 50
+
+# Formats for download: the file extension and mime type of each
+EXPORT_FORMATS = {'csv': ('csv', 'text/csv'),
+                  'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+                  'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+
+def cached_rubric_usage(files):
+    """Returns {name: rubric item analysis} for ' All' and each problem in files, most significant first, from the
+       cache if the same files have been analyzed before. See gradescopeAnalysis.rubric_usage. Everything returned
+       is shared with other sessions, so it must not be changed."""
+
+    def analyze_rubrics():
+        rubric_df = rubric_usage(files).sort_values('p-value', kind = 'stable', ignore_index = True)
+        tables = {' All': rubric_df}
+        tables.update({problem: table.reset_index(drop = True) for problem, table in rubric_df.groupby('Problem', sort = False)})
+        return tables
+
+    return result_cache().get_or_compute(upload_key(files) + ':rubric', analyze_rubrics)
+
+def download_buttons(df, label, fileName, key, index = True):
+    """Shows a menu of formats and a button to prepare df for download. The file is only made when the button is
+       clicked, and is then kept in the session with a download button, until df or the format changes. df must
+       not be changed in place (dataframes from the cache never are)."""
+    formatCol, buttonCol = st.columns([1, 3])
+    fileFormat = formatCol.selectbox('Format', list(EXPORT_FORMATS), key = key + '_format', label_visibility = 'collapsed')
+    if buttonCol.button('Prepare ' + label, key = key + '_prepare'):
+        try:
+            st.session_state[key + '_export'] = (df, fileFormat, export_bytes(df, fileFormat, index))
+        except ImportError as err:
+            st.error(f'Could not make the {fileFormat} file: {err}')
+
+    # A file made from an earlier table or in another format is not offered
+    prepared = st.session_state.get(key + '_export')
+    if prepared is not None and prepared[0] is df and prepared[1] == fileFormat:
+        extension, mime = EXPORT_FORMATS[fileFormat]
+        st.download_button('Download ' + label, prepared[2], f'{fileName}.{extension}', mime, key = key)
+
+def export_bytes(df, fileFormat, index = True):
+    """The contents of a file of df in fileFormat (one of EXPORT_FORMATS). Parquet needs pyarrow, and Excel needs
+       openpyxl."""
+    if fileFormat == 'csv':
+        return df.to_csv(index = index).encode('utf-8')
+    buffer = io.BytesIO()
+    if fileFormat == 'Parquet':
+        df.to_parquet(buffer, index = index)
+    else:
+        df.to_excel(buffer, index = index)
+    return buffer.getvalue()
+
+def prepare_graph(df):
+    """Create a bar chart of the mean of each grader, with error bars showing the 95% confidence interval of the
+       grader's difference from the mean of all graders, and a horizontal line showing that mean. Graders whose
+       interval does not include zero are in red."""
+
+    # Copy the dataframe for graphing
+    plt_df = df.copy()
+    plt_df['Grader'] = plt_df.index
+    plt_df['ci_plus'] = (plt_df['95% CI high'] - plt_df['difference']).fillna(0)
+    plt_df['ci_minus'] = (plt_df['difference'] - plt_df['95% CI low']).fillna(0)
+    plt_df['Different'] = plt_df['significant'].map({True: 'Yes', False: 'No'})
+
+    # Now put the columns in order of mean. Split off the first (' All') column, alphabetize, then recombine
+    df_header = plt_df.iloc[[0]]
+    df_rest = plt_df.iloc[1:]
+    df_rest = df_rest.sort_values(by='mean', ascending=True)
+    plt_df = pd.concat([df_header, df_rest])
+
+    # Show the ends of the error bars, with a margin of a quarter of the std dev of all of the scores
+    low = (plt_df['mean'] - plt_df['ci_minus']).min()
+    high = (plt_df['mean'] + plt_df['ci_plus']).max()
+    margin = 0.25 * plt_df['std dev'].iloc[0] if plt_df['std dev'].iloc[0] > 0 else 1
+
+    # Figure generation
+    fig = px.bar(
+        plt_df,
+        x='Grader',
+        y="mean",
+        error_y="ci_plus",
+        error_y_minus="ci_minus",
+        color='Different',
+        color_discrete_map={'No': 'darkkhaki', 'Yes': 'indianred'},
+        category_orders={'Grader': list(plt_df['Grader'])},
+        hover_data=['std dev', 'count', 'difference'],
+        title="Mean by Grader, with 95% Confidence Interval of the Difference from the Mean"
+    )
+    fig.update_yaxes(range=[low - margin, high + margin])
+    fig.add_hline(y=plt_df['mean'].iloc[0], annotation_text="mean",
+          line_dash="dot", line_color='black')
+    return fig
+
+def prepare_bias_graph(bias_df):
+    """Create a bar chart of each grader's raw and adjusted offset, side by side, in order of adjusted offset."""
+    plt_df = bias_df.sort_values(by='Adjusted Offset').reset_index()
+    plt_df = plt_df.melt(id_vars='Grader', value_vars=['Raw Offset', 'Adjusted Offset'],
+                         var_name='Offset', value_name='Points')
+    fig = px.bar(
+        plt_df,
+        x='Grader',
+        y='Points',
+        color='Offset',
+        barmode='group',
+        color_discrete_sequence=['lightgray', 'darkkhaki'],
+        title="Points per Problem Above the Average Grader"
+    )
+    fig.add_hline(y=0, line_dash="dot", line_color='black')
+    return fig
+
+def paged_table(df, key, hide_index = False):
+    """Shows df a page at a time, with menus to pick the columns, sort by a column and show only the rows containing
+       some text. All of this is done on the server, so only the page being shown is sent to the browser. The rows
+       are only sorted and filtered again when the settings change. df must not be changed in place."""
+    with st.expander('Columns, sorting and filter'):
+        columns = st.multiselect('Columns', list(df.columns), default = list(df.columns), key = key + '_columns')
+        sortCol, orderCol = st.columns([3, 1])
+        sortBy = sortCol.selectbox('Sort by', [None] + list(df.columns), format_func = lambda col: '(unsorted)' if col is None else col,
+                                   key = key + '_sort')
+        descending = orderCol.checkbox('Descending', key = key + '_descending')
+        filterText = st.text_input('Only rows containing', key = key + '_filter')
+
+    # Reuse the rows from the last rerun if nothing has changed, otherwise work them out and go back to page 1
+    settings = (sortBy, descending, filterText, tuple(columns))
+    view = st.session_state.get(key + '_view')
+    if view is None or view[0] is not df or view[1] != settings:
+        view = (df, settings, table_rows(df, columns, sortBy, descending, filterText))
+        st.session_state[key + '_view'] = view
+        st.session_state[key + '_page'] = 1
+    rows = view[2]
+
+    numPages = max(1, -(-len(rows) // PAGE_ROWS))
+    st.session_state[key + '_page'] = min(st.session_state.get(key + '_page', 1), numPages)
+    page = st.number_input(f'Page (of {numPages})', min_value = 1, max_value = numPages, step = 1, key = key + '_page')
+
+    start = (page - 1) * PAGE_ROWS
+    pageRows = rows[start:start + PAGE_ROWS]
+    st.dataframe(df.iloc[pageRows][columns], hide_index = hide_index)
+    shown = f'Rows {start + 1}-{start + len(pageRows)} of {len(rows)}' if len(rows) > 0 else 'No rows'
+    st.caption(shown + (f' ({len(df)} before the filter)' if len(rows) < len(df) else ''))
+
+def table_rows(df, columns, sortBy = None, descending = False, filterText = ''):
+    """The positions of the rows of df to show in a paged_table: those with filterText (ignoring case) in any of
+       columns, in order of sortBy (blanks last), or in their original order if sortBy is None."""
+    rows = np.arange(len(df))
+    if filterText:
+        keep = np.zeros(len(df), dtype = bool)
+        for col in columns:
+            keep |= contains_text(df[col], filterText)
+        rows = rows[keep]
+    if sortBy is not None:
+        values = df[sortBy].iloc[rows].reset_index(drop = True)
+        order = values.sort_values(ascending = not descending, kind = 'stable', na_position = 'last').index.to_numpy()
+        rows = rows[order]
+    return rows
+
+def contains_text(column, text):
+    """Whether each value of column contains text, ignoring case. For a category, only the categories are
+       searched."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        found = column.cat.categories.astype(str).str.contains(text, case = False, regex = False)
+        codes = column.cat.codes.to_numpy()
+        return np.asarray(found, dtype = bool)[codes] & (codes >= 0)
+    return column.astype(str).str.contains(text, case = False, regex = False).to_numpy(dtype = bool) & column.notna().to_numpy()
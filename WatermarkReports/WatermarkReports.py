@@ -9,12 +9,48 @@
 #   – Adjusts all pdf's to the same number of pages to help Gradescope auto-assign pages.
 #   – Produces file Outline.pdf which is used for preparing assignment in Gradescope
 #
+#   These steps run as a pipeline: pdfs are cleaned while Word files are still being converted, page counts
+#     are taken as each pdf is cleaned, and stamping starts as soon as the final report length is known.
+#     Use --cleaners to set how many pdfs are cleaned at once (default: one per CPU).
+#
+#   Word files are converted with Microsoft Word (via docx2pdf) by default. On a machine without Word, e.g. a
+#     Linux server, use --converter libreoffice to convert them with several headless LibreOffice processes
+#     at once. See wordConverters.py.
+#
+#   Phone-scanned reports can be huge. --downsample-dpi 150 downsamples any images that are well above 150 dpi
+#     with Ghostscript while the pdfs are being cleaned, and converts image-only (scanned) reports to grayscale
+#     unless --keep-color is given. See downsampleImages.py.
+#
+#   By default each report page is merged onto a copy of a watermark page, which rewrites the report's content
+#     uncompressed. --stamp-mode xobject instead draws the watermark underneath the unchanged report pages,
+#     which keeps the stamped reports close to the size of the originals. --compress makes a final pass over
+#     each stamped report with mutool (and qpdf, if it is installed) to merge duplicate objects and compress.
+#
+#   Reports are stamped by several worker processes (--stampers), each allowed --worker-memory-mb of extra
+#     memory. Reports with more than --large-pages pages or bigger than --large-mb MB are flagged when they are
+#     cleaned and stamped a few pages at a time in a separate low-memory lane, as are reports that run out of
+#     memory in an ordinary worker. If a worker is killed (e.g. by the operating system for using too much memory),
+#     its pool is restarted and the reports it was working on are retried in the low-memory lane.
+#
+#   A report that cannot be converted, cleaned or stamped, or whose student ID is not in the gradebook, is moved
+#     to --quarantine-folder (default Quarantine) and the rest carry on. At the end, RunReport.json (--report)
+#     records the time each stage took on each report, its pages, its size before and after, and any errors,
+#     and the slowest reports are printed.
+#
+#   --bundle-mb 200 also packs the stamped reports into a few pdfs of up to 200 MB each for Gradescope's bulk
+#     upload, with a map (BundleMap.csv/.json) of which pages belong to which student. See MergePDFsInDirectory.
+#
 #   This script requires the installation of mutool, a free command line pdf tool, using
 #       brew install mupdf-tools
 #   If you need to install brew first, follow the instructions under "Install Homebrew" at
 #       https://brew.sh
 #
-#   This script requires the file 'Watermark.pdf' to be in the working directory. This file consists
+#   Reports are lengthened to at most --page-cap pages (default 24, which is all Gradescope seems to handle;
+#     0 for no cap). Pages beyond the length of the watermark are not watermarked. --watermark generated makes
+#     watermark pages for whatever length is needed instead of using Watermark.pdf, and caches them, so Outline.pdf
+#     and the stamped reports can be as long as the longest report. See generateWatermark.py.
+#
+#   By default this script requires the file 'Watermark.pdf' to be in the working directory. This file consists
 #     of a _scanned_ set of pages with numbers running down the right and left hand sides. It is
 #     important that this be a _scanned_ file for Gradescope matching. A pdf file with text does not work.
 #     I tried just having the numbers run down only the right hand side, but Gradescope would not auto-recognize
@@ -27,15 +63,59 @@
 #   Some pdf files do not watermark properly. These files appear to have an opaque white background behind
 #     the text. A scanned file would probably not watermark correctly either.
 
-from docx2pdf import convert
-from PyPDF2 import PdfFileReader, PdfFileWriter, PdfFileMerger
+from PyPDF2 import PdfFileReader, PdfFileWriter, PageObject
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
 from fpdf import FPDF
 import os
+import io
 import pandas as pd
 import sys
 import argparse
 import subprocess
 import glob
+import hashlib
+import json
+import shutil
+import multiprocessing
+import queue
+import collections
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from wordConverters import get_converter
+from downsampleImages import downsample_pdf, find_gs
+from generateWatermark import watermark_pdf, CACHE_FOLDER
+
+# The stages of the script (convert, clean, count pages, stamp) run concurrently and pass file names
+#   to each other through queues of this depth. Small queues keep a fast stage from running far ahead
+#   of a slow one.
+QUEUE_DEPTH = 8
+
+# For unknown reasons, Gradescope does not like more than 24 pages using this approach
+GRADESCOPE_MAX_PAGES = 24
+
+# Pass this instead of the path of a watermark file to have the watermark pages made for the reports' length
+GENERATED_WATERMARK = 'generated'
+
+# Reports that are stamped in the low-memory lane are written this many pages at a time
+LOW_MEMORY_CHUNK = 8
+
+# Settings for the pipeline, which can be changed with command line arguments
+PIPELINE_DEFAULTS = {'downsampleDPI': 0,            # Downsample scanned images to this resolution. 0 to leave them
+                     'keepColor': False,            # Do not convert image-only reports to grayscale when downsampling
+                     'stampMode': 'merge',          # 'merge' or 'xobject' (see stamp_report)
+                     'compress': False,             # Recompress each stamped report (see compress_pdf)
+                     'numStampers': os.cpu_count(), # Number of worker processes stamping ordinary reports
+                     'workerMemoryMB': 1024,        # Extra memory each stamping worker may allocate. 0 for no cap
+                     'largePages': 40,              # Reports with more pages than this go to the low-memory lane
+                     'largeMB': 50,                 # So do reports bigger than this
+                     'bundleMB': 0,                 # Pack the stamped reports into bundles of this size. 0 for no bundles
+                     'bundleFolder': 'Bundles',     # Folder for the bundles and their page map
+                     'pageCap': GRADESCOPE_MAX_PAGES,   # Reports are lengthened to at most this many pages. 0 for no cap
+                     'watermarkCache': CACHE_FOLDER,    # Where generated watermarks are kept (see generateWatermark.py)
+                     'quarantineFolder': 'Quarantine',  # Reports that could not be processed are moved here
+                     'reportPath': 'RunReport.json'}    # Where to save the record of what happened to each report
 
 def main():
     
@@ -43,6 +123,39 @@ def main():
     parser = argparse.ArgumentParser(description="Prepare a folder of downloads from Canvas for upload to Gradescope")
     parser.add_argument('gradesCSV', type = str, help = 'Path to gradebook in csv format')
     parser.add_argument('subFolder', type = str, help = 'Path to folder of Canvas submissions')
+    parser.add_argument('--watermark', type = str, default = 'Watermark.pdf',
+                        help = f'Scanned watermark file, or "{GENERATED_WATERMARK}" to make watermark pages for any length')
+    parser.add_argument('--page-cap', type = int, default = PIPELINE_DEFAULTS['pageCap'],
+                        help = 'Lengthen reports to at most this many pages (0 for no cap)')
+    parser.add_argument('--watermark-cache', type = str, default = PIPELINE_DEFAULTS['watermarkCache'],
+                        help = 'Folder where generated watermarks are kept')
+    parser.add_argument('--cleaners', type = int, default = os.cpu_count(), help = 'Number of pdfs cleaned at once')
+    parser.add_argument('--converter', choices = ['word', 'libreoffice'], default = 'word',
+                        help = 'Program used to convert .doc/.docx files to pdf')
+    parser.add_argument('--profiles', type = int, default = 4, help = 'Number of LibreOffice processes run at once')
+    parser.add_argument('--batch-size', type = int, default = 10, help = 'Number of files converted per LibreOffice process')
+    parser.add_argument('--convert-timeout', type = float, default = 60, help = 'Seconds allowed to convert each Word file')
+    parser.add_argument('--downsample-dpi', type = int, default = PIPELINE_DEFAULTS['downsampleDPI'],
+                        help = 'Downsample scanned images to this resolution with Ghostscript (e.g. 150). 0 to leave them alone')
+    parser.add_argument('--keep-color', action = 'store_true', help = 'Do not convert scanned reports to grayscale when downsampling')
+    parser.add_argument('--stamp-mode', choices = ['merge', 'xobject'], default = 'merge',
+                        help = 'merge: merge each page onto a watermark page; xobject: draw the watermark under the unchanged page')
+    parser.add_argument('--compress', action = 'store_true', help = 'Recompress each stamped report with mutool (and qpdf if installed)')
+    parser.add_argument('--stampers', type = int, default = PIPELINE_DEFAULTS['numStampers'], help = 'Number of reports stamped at once')
+    parser.add_argument('--worker-memory-mb', type = int, default = PIPELINE_DEFAULTS['workerMemoryMB'],
+                        help = 'Memory each stamping process may use on top of what it starts with (0 for no limit)')
+    parser.add_argument('--large-pages', type = int, default = PIPELINE_DEFAULTS['largePages'],
+                        help = 'Reports longer than this are stamped a few pages at a time in a separate process')
+    parser.add_argument('--large-mb', type = float, default = PIPELINE_DEFAULTS['largeMB'],
+                        help = 'Reports bigger than this are stamped a few pages at a time in a separate process')
+    parser.add_argument('--bundle-mb', type = float, default = PIPELINE_DEFAULTS['bundleMB'],
+                        help = 'Also pack the stamped reports into pdfs of up to this size for bulk upload (0 for none)')
+    parser.add_argument('--bundle-folder', type = str, default = PIPELINE_DEFAULTS['bundleFolder'],
+                        help = 'Folder for the bundles and the map of which pages belong to whom')
+    parser.add_argument('--quarantine-folder', type = str, default = PIPELINE_DEFAULTS['quarantineFolder'],
+                        help = 'Folder that reports which could not be processed are moved to')
+    parser.add_argument('--report', type = str, default = PIPELINE_DEFAULTS['reportPath'],
+                        help = 'Save a json record of the time, pages, size and errors of every report to this file')
     args = parser.parse_args()
     gradesCSV = args.gradesCSV
     subFolder = args.subFolder
@@ -60,10 +173,90 @@ def main():
         print(f'ERROR: {subFolder} is not a valid directory.')
         exit()
 
-    if not os.path.isfile('Watermark.pdf'):
-        print(f'ERROR: The file Watermark.pdf is not in the current directory.')
+    if args.watermark != GENERATED_WATERMARK and not os.path.isfile(args.watermark):
+        print(f'ERROR: The watermark file {args.watermark} does not exist.')
+        exit()
+
+    if args.downsample_dpi > 0 and find_gs() is None:
+        print(f'ERROR: --downsample-dpi requires Ghostscript (gs), which is not installed.')
+        exit()
+
+    try:
+        converter = get_converter(args.converter, args.profiles, args.batch_size, args.convert_timeout)
+    except RuntimeError as err:
+        print(f'ERROR: {err}')
         exit()
 
+    prepare_reports(gradesCSV, subFolder, converter, max(args.cleaners, 1), wmPath = args.watermark,
+                    pageCap = max(args.page_cap, 0), watermarkCache = args.watermark_cache,
+                    downsampleDPI = args.downsample_dpi, keepColor = args.keep_color, stampMode = args.stamp_mode, compress = args.compress, numStampers = max(args.stampers, 1),
+                    workerMemoryMB = args.worker_memory_mb, largePages = args.large_pages, largeMB = args.large_mb,
+                    bundleMB = args.bundle_mb, bundleFolder = args.bundle_folder,
+                    quarantineFolder = args.quarantine_folder, reportPath = args.report)
+
+def prepare_reports(gradesCSV, subFolder, converter, numCleaners, wmPath = 'Watermark.pdf', outlinePath = 'Outline.pdf',
+                    **options):
+    """Prepares every report in subFolder for Gradescope and writes the outline to outlinePath. options
+       override PIPELINE_DEFAULTS. Saves a RunReport of what happened to each report to options['reportPath']
+       and returns it."""
+    options = {**PIPELINE_DEFAULTS, **options}
+
+    df = read_gradebook(gradesCSV)
+
+    # The watermark is held in memory as the bytes of a pdf with numbers running down both sides of each page.
+    #   Each stamped report gets its own reader on these bytes, as merging pages modifies the watermark pages.
+    #   load_watermark(numPages) returns the bytes once the number of pages is known.
+    pageCap = options['pageCap'] or float('inf')
+    if wmPath == GENERATED_WATERMARK:
+        # Generated watermarks can be as long as the longest report, so only the page cap applies
+        def load_watermark(numPages):
+            return watermark_pdf(max(numPages, 1), cacheFolder = options['watermarkCache'])
+    else:
+        # The Watermark file contains 30 pages. We are going to have a problem with files that are longer than
+        #   the watermark file. My solution is just not to watermark the excess pages. This may cause Gradescope
+        #   to get confused, but I doubt it.
+        with open(wmPath, 'rb') as wm_file:
+            wmBytes = wm_file.read()
+        pageCap = min(PdfFileReader(io.BytesIO(wmBytes)).getNumPages(), pageCap)
+
+        def load_watermark(numPages):
+            return wmBytes
+
+    # The stages all work inside the submissions folder
+    outlinePath = os.path.abspath(outlinePath)
+    bundleFolder = os.path.abspath(options['bundleFolder'])
+    options['quarantineFolder'] = os.path.abspath(options['quarantineFolder'])
+    reportPath = os.path.abspath(options['reportPath'])
+    cwd = os.getcwd()
+    os.chdir(subFolder)
+    try:
+        report = run_pipeline(df, load_watermark, pageCap, outlinePath, numCleaners, converter, options)
+        if options['bundleMB'] > 0:
+            start = time.time()
+            MergePDFsInDirectory(df, bundleFolder, options['bundleMB'])
+            report.add('bundle', start, time.time())
+    finally:
+        os.chdir(cwd)
+
+    report.write(reportPath)
+    print_run_summary(report, reportPath)
+    return report
+
+def print_run_summary(report, reportPath):
+    """Prints the number of reports that were quarantined and where the time went on the slowest ones."""
+    quarantined = report.quarantined()
+    print(f'{len(report.files) - len(quarantined)} reports prepared, {len(quarantined)} quarantined.')
+    if len(quarantined) > 0:
+        print(f'Check the files in {report.quarantineFolder}: ' + ', '.join(quarantined))
+    print('Slowest reports:')
+    for record in report.slowest():
+        stages = ', '.join(f'{stage} {seconds:.1f} s' for stage, seconds in record['seconds'].items())
+        print(f'    {sum(record["seconds"].values()):6.1f} s  {record["file"]}  ({stages})')
+    print(f'Details of every report are in {reportPath}.')
+
+def read_gradebook(gradesCSV):
+    """Reads the names and IDs from a Canvas gradebook csv. Returns a dataframe with columns Name and ID."""
+
     # Canvas gradebook csv's can have a variable number of header rows. Open the gradebook,
     #    count the number of lines that do not start with ", then close the gradebook
     gradebookFile = open(gradesCSV, 'r')
@@ -80,168 +273,711 @@ def main():
     #   Unfortunately, cannot find documentation of file structure.
     df = pd.read_csv(gradesCSV, usecols=[0,1], header=cnt-1)
     df.columns = ['Name', 'ID']
+    return df
 
-    # Open the Watermark file. This pdf file contains 30 pages with numbers running down both sides.
-    wm_file = open('Watermark.pdf', 'rb')
+class RunReport:
+    """Records what happens to each report and how long each stage of the pipeline spends working.
 
-    # Test for word files before firing up Word
-    cwd = os.getcwd()
-    os.chdir(subFolder)
-    types = ('*.doc', '*.docx')
+    For each stage we keep the total time spent working (summed over threads), the wall clock time from
+    when the stage started its first file to when it finished its last, and the number of files.
+    For each file we keep the time each stage spent on it, its number of pages, its size before and after,
+    and the error, if any, that sent it to the quarantine folder.
+    """
+
+    def __init__(self, quarantineFolder):
+        self._lock = threading.Lock()
+        self.quarantineFolder = quarantineFolder
+        self.stages = {}
+        self.files = {}
+
+    def _record(self, fn):
+        return self.files.setdefault(fn, {'file': fn, 'status': 'ok', 'pages': None, 'bytesIn': None,
+                                          'bytesOut': None, 'seconds': {}, 'errors': []})
+
+    def add(self, stage, start, end, files = 1, fn = None):
+        with self._lock:
+            times = self.stages.setdefault(stage, {'busy': 0.0, 'first': start, 'last': end, 'files': 0})
+            times['busy'] += end - start
+            times['first'] = min(times['first'], start)
+            times['last'] = max(times['last'], end)
+            times['files'] += files
+            if fn is not None:
+                seconds = self._record(fn)['seconds']
+                seconds[stage] = seconds.get(stage, 0.0) + end - start
+
+    def note(self, fn, **fields):
+        """Sets fields (pages, bytesIn, bytesOut) in the record for fn."""
+        with self._lock:
+            self._record(fn).update(fields)
+
+    def warn(self, fn, stage, err):
+        """Records an error that did not stop fn from being processed."""
+        print(f'ERROR: Could not {stage} {fn}: {err}')
+        with self._lock:
+            self._record(fn)['errors'].append({'stage': stage, 'error': str(err)})
+
+    def rename(self, fn, newName):
+        """Moves the record for fn to newName, e.g. when a Word file has been converted to pdf."""
+        with self._lock:
+            record = self.files.pop(fn, None) or self._record(newName)
+            record.setdefault('source', fn)
+            record['file'] = newName
+            self.files[newName] = record
+
+    def fail(self, fn, stage, err):
+        """Records that fn failed at stage and moves it to the quarantine folder, so the rest of the batch
+           can carry on and the folder only holds reports that are ready for Gradescope."""
+        print(f'ERROR: Could not {stage} {fn}: {err}. Moved it to {self.quarantineFolder}.')
+        with self._lock:
+            record = self._record(fn)
+            record['status'] = 'quarantined'
+            record['errors'].append({'stage': stage, 'error': str(err)})
+        if os.path.exists(fn):
+            os.makedirs(self.quarantineFolder, exist_ok = True)
+            shutil.move(fn, os.path.join(self.quarantineFolder, fn))
+
+    def quarantined(self):
+        with self._lock:
+            return [fn for fn, record in self.files.items() if record['status'] == 'quarantined']
+
+    def summary(self):
+        """Returns {stage: {'busy': seconds, 'wall': seconds, 'files': count}}."""
+        with self._lock:
+            return {stage: {'busy': t['busy'], 'wall': t['last'] - t['first'], 'files': t['files']}
+                    for stage, t in self.stages.items()}
+
+    def slowest(self, count = 5):
+        """Returns the records of the count files that took longest, summed over all stages."""
+        with self._lock:
+            records = sorted(self.files.values(), key = lambda record: sum(record['seconds'].values()), reverse = True)
+            return records[:count]
+
+    def write(self, path):
+        """Saves the stage summary and the record for every file as json."""
+        report = {'stages': self.summary(), 'quarantineFolder': self.quarantineFolder}
+        with self._lock:
+            report['files'] = sorted(self.files.values(), key = lambda record: record['file'])
+        with open(path, 'w') as reportFile:
+            json.dump(report, reportFile, indent = 2)
+
+def run_pipeline(df, load_watermark, pageCap, outlinePath, numCleaners, converter, options):
+    """Converts, cleans, counts and stamps every report in the current directory. Returns the RunReport.
+
+    The stages are connected by bounded queues, so Word conversion, cleaning and page counting overlap.
+    Stamping needs the length of the longest report, so it starts as soon as that is known: either
+    when some report reaches pageCap pages or when the last report has been counted.
+
+    Stamping is done by worker processes, each limited to options['workerMemoryMB'] of extra memory.
+    Reports that are flagged as large when they are cleaned, or that run out of memory, are stamped
+    a few pages at a time by a separate worker so they cannot starve the ordinary reports.
+
+    A report that fails at any stage, or whose student ID is not in the gradebook, is moved to
+    options['quarantineFolder'] and the rest of the batch carries on.
+    """
+    report = RunReport(options['quarantineFolder'])
+
+    # Sort the folder into Word files, which need converting, and pdfs. Anything else is deleted.
     wordFiles = []
-    for files in types:
+    for files in ('*.doc', '*.docx'):
         wordFiles.extend(glob.glob(files))
-    if len(wordFiles) > 0:
-        os.chdir(cwd)
-        convert(subFolder)  # Converts Word files to pdf
-        os.chdir(subFolder)
-        
-    # "Clean" all of the pdfs using mutool, outputting to a temporary file
-    print("Cleaning pdfs.")
-    for fn in os.listdir():
-        if not fn.endswith('.pdf'):
-            os.remove(fn)
-        else:
-            fn_out = fn + '_out'
-            result = subprocess.run(["mutool", "clean", "-s", "-g", fn, fn_out])
-    
-    # Delete all of the unclean files
+    pdfFiles = []
     for fn in os.listdir():
         if fn.endswith('.pdf'):
+            pdfFiles.append(fn)
+        elif fn not in wordFiles:
             os.remove(fn)
 
-    # Now reclean all of the files using mutool, outputting to the original file name
-    #   This may no longer be necessary, but it is very fast, so what the hey…
-    print("Recleaning pdfs.")
-    for fn in os.listdir():
-        fn_out = fn[:-4]
-        result = subprocess.run(["mutool", "clean", "-s", "-g", fn, fn_out])
-    
-    
-    # Rename the cleaned files to the original name
-    for fn in os.listdir():
-        if fn.endswith('_out'):
-            os.remove(fn)
+    for fn in pdfFiles + wordFiles:
+        report.note(fn, bytesIn = os.path.getsize(fn))
+    bytesIn = sum(record['bytesIn'] for record in report.files.values())
+
+    cleanQueue = queue.Queue(maxsize = QUEUE_DEPTH)
+    countQueue = queue.Queue(maxsize = QUEUE_DEPTH)
+    stampQueue = queue.Queue(maxsize = QUEUE_DEPTH)
+
+    # Stage 1: pdfs go straight to cleaning, while Word files are handed to the converter, which passes
+    #    each pdf on as soon as it has been converted.
+    def feed_pdfs():
+        for fn in pdfFiles:
+            cleanQueue.put(fn)
+
+    def convert_word_files():
+        if len(wordFiles) == 0:
+            return
+        # The converter works on several files at once, so the time charged to each file is the time
+        #    since the previous file came back.
+        start = time.time()
+        finished = set()
+        try:
+            for fn, pdfName in converter.convert(wordFiles):
+                finished.add(fn)
+                end = time.time()
+                report.add('convert', start, end, fn = fn)
+                start = end
+                if pdfName is None:
+                    report.fail(fn, 'convert', 'the converter did not produce a pdf')
+                    continue
+                os.remove(fn)
+                report.rename(fn, pdfName)
+                cleanQueue.put(pdfName)
+        except Exception as err:
+            # The converter itself failed (e.g. docx2pdf is not installed), so none of the rest will be converted
+            for fn in wordFiles:
+                if fn not in finished:
+                    report.fail(fn, 'convert', err)
+
+    # Stage 2: clean each pdf and record its length while we have it open
+    def clean_pdfs():
+        while True:
+            fn = cleanQueue.get()
+            if fn is None:
+                break
+
+            # There is no point cleaning a report we cannot put a name on
+            try:
+                studentID = student_id(fn)
+            except IndexError:
+                report.fail(fn, 'match', 'there is no student ID in the file name')
+                continue
+            if student_name(df, studentID) is None:
+                report.fail(fn, 'match', f'the student ID {studentID} does not exist')
+                continue
+
+            start = time.time()
+            try:
+                numPages = clean_pdf(fn)
+            except Exception as err:
+                report.fail(fn, 'clean', err)
+                continue
+            report.add('clean', start, time.time(), fn = fn)
+            report.note(fn, pages = numPages)
+
+            # Downsampling does not change the number of pages, so it can come after the count.
+            #    The report is fine without it, so a failure here is only recorded.
+            if options['downsampleDPI'] > 0:
+                start = time.time()
+                try:
+                    bytesBefore, bytesAfter = downsample_pdf(fn, options['downsampleDPI'], options['keepColor'])
+                except Exception as err:
+                    report.warn(fn, 'downsample', err)
+                else:
+                    end = time.time()
+                    report.add('downsample', start, end, fn = fn)
+                    if bytesAfter < bytesBefore:
+                        print(f'Downsampled {fn}: {bytesBefore / 1e6:.1f} MB to {bytesAfter / 1e6:.1f} MB '
+                              f'({100 * (1 - bytesAfter / bytesBefore):.0f}% smaller) in {end - start:.1f} s.')
+
+            # Flag very long or very big reports now, before anything tries to stamp them
+            megabytes = os.path.getsize(fn) / 1e6
+            large = numPages > options['largePages'] or megabytes > options['largeMB']
+            if large:
+                print(f'{fn} is large ({numPages} pages, {megabytes:.0f} MB). It will be stamped in the low-memory lane.')
+            countQueue.put((fn, numPages, large))
+
+    # Stage 4: stamp each report once the number of pages is known. Ordinary reports go to a pool of worker
+    #    processes; large ones to a single worker that stamps them a few pages at a time, one report at a time,
+    #    so if that worker dies we know which report killed it.
+    def stamp_reports(maxPages, wmBytes):
+        lanes = StampingLanes(options['numStampers'], (options['workerMemoryMB'], df, wmBytes, maxPages,
+                                                       options['stampMode'], options['compress']))
+        futures = {}            # future: (fn, large, pool)
+        slowWaiting = collections.deque()
+        received = True
+        try:
+            while received or futures or slowWaiting:
+                # Hand every report that is waiting to a lane. Only block on the queue if nothing is stamping.
+                while received:
+                    try:
+                        item = stampQueue.get(block = len(futures) == 0 and len(slowWaiting) == 0)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        received = False
+                        break
+                    fn, large = item
+                    if large:
+                        slowWaiting.append(fn)
+                    else:
+                        futures[lanes.submit(fn, False)] = (fn, False, lanes.pool(False))
+                if slowWaiting and not any(large for fn, large, pool in futures.values()):
+                    fn = slowWaiting.popleft()
+                    futures[lanes.submit(fn, True)] = (fn, True, lanes.pool(True))
+                if len(futures) == 0:
+                    continue
 
-    # Find the maximum number of pages across all files and delete non pdf
+                done, notDone = wait(futures, timeout = 0.5, return_when = FIRST_COMPLETED)
+                for future in done:
+                    fn, large, pool = futures.pop(future)
+                    try:
+                        start, end = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. killed for using too much memory), which breaks every report
+                        #    in its pool. Start a new pool and send the reports to the low-memory lane.
+                        lanes.replace(large, pool)
+                        if large:
+                            report.fail(fn, 'stamp', 'the worker stamping it died, even in the low-memory lane')
+                        else:
+                            print(f'A stamping worker died while {fn} was in its pool. Retrying it in the low-memory lane.')
+                            slowWaiting.append(fn)
+                    except MemoryError:
+                        if large:
+                            report.fail(fn, 'stamp', 'ran out of memory, even in the low-memory lane')
+                        else:
+                            print(f'{fn} ran out of memory. Retrying it in the low-memory lane.')
+                            slowWaiting.append(fn)
+                    except Exception as err:
+                        report.fail(fn, 'stamp', err)
+                    else:
+                        report.add('stamp', start, end, fn = fn)
+                        report.note(fn, bytesOut = os.path.getsize(fn))
+        except Exception as err:
+            # Never leave the pipeline waiting on this thread: fail what is left and keep emptying the queue
+            print(f'ERROR: Stamping stopped: {err}')
+            lanes.shutdown(wait = False)
+            for fn in [fn for fn, large, pool in futures.values()] + list(slowWaiting):
+                report.fail(fn, 'stamp', err)
+            while received:
+                item = stampQueue.get()
+                if item is None:
+                    break
+                report.fail(item[0], 'stamp', err)
+        finally:
+            lanes.shutdown(wait = True)
+
+    print("Converting and cleaning pdfs.")
+    producers = start_threads([feed_pdfs, convert_word_files], cleanQueue, numCleaners)
+    cleaners = start_threads([clean_pdfs] * numCleaners, countQueue, 1)
+
+    # Stage 3: page counting happens here. Reports are held back until the longest length is known.
     maxPages = 0
-    for fn in os.listdir():
-        if not fn.endswith('.pdf'):
-            os.remove(fn)
-        else:
-            with open(fn, "rb") as origReport_file:
-                origReport_reader = PdfFileReader(origReport_file, strict = False)
-                numPages = origReport_reader.getNumPages() 
-                if numPages > maxPages:
-                    maxPages = numPages
-
-    # Now make the Outline.pdf, which consists of watermarked pages. We are going to have a problem
-    #   with files that are longer than the watermark file. My solution is just not to watermark
-    #   the excess pages. This may cause Gradescope to get confused, but I doubt it.
-    wm_reader = PdfFileReader(wm_file)
-    if maxPages >  wm_reader.getNumPages():
-        maxPages = wm_reader.getNumPages()
-    if maxPages > 24:   # For unknown reasons, Gradescope does not like more than 24 pages using this approach
-        maxPages = 24
-            
+    stamper = None
+    heldBack = []
+    while True:
+        item = countQueue.get()
+        if item is None:
+            break
+        fn, numPages, large = item
+        maxPages = max(maxPages, numPages)
+        if stamper is not None:
+            stampQueue.put((fn, large))
+            continue
+        heldBack.append((fn, large))
+        if maxPages >= pageCap:
+            stamper = start_stamping(min(maxPages, pageCap), load_watermark, outlinePath, stamp_reports)
+            for heldItem in heldBack:
+                stampQueue.put(heldItem)
+
+    if stamper is None:
+        stamper = start_stamping(min(maxPages, pageCap), load_watermark, outlinePath, stamp_reports)
+        for heldItem in heldBack:
+            stampQueue.put(heldItem)
+    stampQueue.put(None)
+    stamper.join()
+    producers.join()
+    cleaners.join()
+
+    bytesOut = sum(os.path.getsize(fn) for fn in os.listdir() if fn.endswith('.pdf'))
+    print(f'Submissions: {bytesIn / 1e6:.1f} MB in, {bytesOut / 1e6:.1f} MB out.')
+    return report
+
+def start_threads(targets, outQueue, numSentinels):
+    """Starts a thread for each of targets, plus a thread that waits for them all to finish and then puts
+       numSentinels None's on outQueue to tell the next stage that there is nothing more coming. Returns the
+       waiting thread."""
+    workers = [threading.Thread(target = target, daemon = True) for target in targets]
+    for worker in workers:
+        worker.start()
+
+    def close_queue():
+        for worker in workers:
+            worker.join()
+        for i in range(numSentinels):
+            outQueue.put(None)
+
+    closer = threading.Thread(target = close_queue, daemon = True)
+    closer.start()
+    return closer
+
+def start_stamping(maxPages, load_watermark, outlinePath, stamp_reports):
+    """Writes Outline.pdf, which consists of maxPages watermarked pages, then starts the stamping thread."""
     print(f'All reports will be lengthened to {maxPages} pages.')
 
-    os.chdir(cwd)
-    with open('Outline.pdf', 'wb') as outline_file:
+    wmBytes = load_watermark(maxPages)
+    wm_reader = PdfFileReader(io.BytesIO(wmBytes))
+    with open(outlinePath, 'wb') as outline_file:
         outline_writer = PdfFileWriter()
         for i in range(maxPages):
             outline_writer.addPage(wm_reader.getPage(i))
         outline_writer.write(outline_file)
-        outline_file.close()
-    os.chdir(subFolder)
 
-    # Loop through every file in the submissionsFolder directory, processing each
-    for fn in os.listdir():
-        if fn.endswith('.pdf'):
-    
-            # Find student ID from Canvas filename
-            fnParts = fn.split('_')
-            i = 0
-            while not fnParts[i].isnumeric():
-                i += 1
-            studentID = int(fnParts[i])
-    
-            # Extract name from database
-            if len(df.loc[df['ID']==studentID]) > 0:           
-                nameParts = df.iloc[df.loc[df['ID']==studentID].index.values[0],0].split(',')
-                fullName = nameParts[1] + ' ' + nameParts[0]
-                print('Processing ' + fullName + '…')
-    
-                # Make cover page 'cover.pdf' with students name in upper left hand corner
-                # Arial bold seemed to have the best OCR of the fonts readily available to FPDF
-                coverPDF = FPDF('P', 'mm', 'Letter')
-                coverPDF.add_page()            
-                coverPDF.set_font("Arial", style = 'B',size = 16)
-                coverPDF.cell(0, 0, fullName,ln = 1, align = 'L')
-                coverPDF.output('cover.pdf')
-    
-                # Open the output file 'Output.pdf' then start processing
-                with open('Output.pdf', 'wb') as output_file:
-                    outReport_writer = PdfFileWriter()
-                    wm_reader = PdfFileReader(wm_file)
-            
-                    # Open the watermark pdf, then merge the report and the cover page (for page 1)
-                    #    If the report is longer than the watermark pdf, just tack the excess pages
-                    #    on the end. The output is put into Output.pdf
-                    with open('cover.pdf', 'rb') as cover_file:
-                        cover_reader = PdfFileReader(cover_file)
-                        with open(fn, 'rb') as origReport_file:
-                            origReport_reader = PdfFileReader(origReport_file, strict = False)
-                            origPages = origReport_reader.getNumPages()
-                            for i in range(maxPages):
-                                pdf_page = wm_reader.getPage(i)
-                                if i < origPages:
-                                    pdf_page.mergePage(origReport_reader.getPage(i))
-                                if i == 0:                            
-                                    pdf_page.mergePage(cover_reader.getPage(0))
-                                outReport_writer.addPage(pdf_page)            
-                            if origPages > maxPages:    # Handle the extra long reports here
-                                for i in range(maxPages, origPages):
-                                    outReport_writer.addPage(origReport_reader.getPage(i))
-                            outReport_writer.write(output_file)
-                            output_file.close() 
-                            origReport_file.close()
-                        cover_file.close()
-                    # Remove the cover page, which is no longer needed.
-                    os.remove('cover.pdf')
-                
-                    # Rename Output.pdf to the original filename.
-                    os.rename('Output.pdf', fn)
-            else:
-                print(f'The student ID {studentID} does not exist.')
-
-    wm_file.close()
-
-# The following function merges all PDFs in the current directory into some number of merged PDFs
-#    with names Merge0.pdf, Merge1.pdf, etc. The variable numPerFile determines how many files
-#    are included in each merged file. This function is not currently used.
+    stamper = threading.Thread(target = stamp_reports, args = (maxPages, wmBytes), daemon = True)
+    stamper.start()
+    return stamper
+
+def clean_pdf(fn):
+    """Cleans a pdf in place using mutool (scanned pdfs are particularly problematic). Returns the number of pages.
+       Raises RuntimeError, leaving the original untouched, if mutool cannot clean it."""
+
+    # Clean into a temporary file, then reclean that into a second one. The second pass may no longer be
+    #   necessary, but it is very fast, so what the hey… The original is only replaced once both have worked.
+    fn_out = fn + '_out'
+    fn_reclean = fn + '_reclean'
+    try:
+        for source, dest in ((fn, fn_out), (fn_out, fn_reclean)):
+            result = subprocess.run(["mutool", "clean", "-s", "-g", source, dest],
+                                    stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+            if result.returncode != 0 or not os.path.isfile(dest):
+                raise RuntimeError(f'mutool clean failed: {result.stderr.strip()}')
+        os.replace(fn_reclean, fn)
+    finally:
+        for leftover in (fn_out, fn_reclean):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    # The cleaned file has a fresh xref, so the page count can be read without walking every page.
+    return count_pages(fn)
+
+def count_pages(fn):
+    """Returns the number of pages in a pdf, read from the root of its page tree."""
+    with open(fn, 'rb') as report_file:
+        report_reader = PdfFileReader(report_file, strict = False)
+        return int(report_reader.trailer['/Root']['/Pages']['/Count'])
+
+def student_id(fn):
+    """Returns the student ID from a Canvas file name, e.g. 123456 from smithjane_LATE_123456_7891011_Report.pdf"""
+    fnParts = fn.split('_')
+    i = 0
+    while not fnParts[i].isnumeric():
+        i += 1
+    return int(fnParts[i])
+
+def student_name(df, studentID):
+    """Looks up a student ID in the gradebook. Returns the name as 'First Last' or None if the ID is unknown."""
+    matches = df.loc[df['ID'] == studentID]
+    if len(matches) == 0:
+        return None
+    nameParts = matches.iloc[0, 0].split(',')
+    return nameParts[1] + ' ' + nameParts[0]
+
+class StampingLanes:
+    """The two pools of stamping processes: numStampers workers for ordinary reports and one for large reports.
+
+    Each worker is given the gradebook, the watermark and the other settings once, when it starts (see
+    start_stamp_worker), so only the file name is sent with each report. A pool whose worker has died is
+    broken for good, so replace starts a new one.
+    """
+
+    def __init__(self, numStampers, workerArgs):
+        self._context = multiprocessing.get_context('spawn')
+        self._sizes = {False: max(numStampers, 1), True: 1}
+        self._workerArgs = workerArgs
+        self._pools = {}
+
+    def pool(self, large):
+        """The pool for large or ordinary reports, started when it is first needed."""
+        if large not in self._pools:
+            self._pools[large] = ProcessPoolExecutor(self._sizes[large], self._context, start_stamp_worker, self._workerArgs)
+        return self._pools[large]
+
+    def submit(self, fn, large):
+        """Starts stamping fn in the right lane. Returns the future."""
+        try:
+            return self.pool(large).submit(stamp_worker, fn, large)
+        except BrokenProcessPool:
+            self.replace(large, self._pools[large])
+            return self.pool(large).submit(stamp_worker, fn, large)
+
+    def replace(self, large, brokenPool):
+        """Replaces brokenPool with a new pool, unless that has already been done."""
+        if self._pools.get(large) is brokenPool:
+            del self._pools[large]
+            brokenPool.shutdown(wait = False, cancel_futures = True)
+
+    def shutdown(self, wait = True):
+        for pool in self._pools.values():
+            pool.shutdown(wait = wait, cancel_futures = not wait)
+        self._pools = {}
+
+def start_stamp_worker(megabytes, df, wmBytes, maxPages, stampMode, compress):
+    """Initializer for the stamping processes. Keeps the settings shared by every report for stamp_worker,
+       then caps the worker's memory (see limit_worker_memory)."""
+    global _stampSettings
+    _stampSettings = {'df': df, 'wmBytes': wmBytes, 'maxPages': maxPages, 'stampMode': stampMode, 'compress': compress}
+    limit_worker_memory(megabytes)
+
+def limit_worker_memory(megabytes):
+    """The memory cap of a stamping process, set by start_stamp_worker. Stops the process from allocating more
+       than megabytes on top of what it is using now, so one huge report gets a MemoryError instead of taking
+       over the machine.
+       Only works where the address space can be limited and measured (Linux); elsewhere there is no cap."""
+    if megabytes <= 0:
+        return
+    try:
+        import resource
+        with open('/proc/self/statm') as statm:
+            inUse = int(statm.read().split()[0]) * resource.getpagesize()
+        limit = inUse + megabytes * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, OSError, ValueError):
+        pass
+
+def stamp_worker(fn, lowMemory):
+    """Stamps (and optionally compresses) one report in a worker process started by start_stamp_worker.
+       Returns the start and end times."""
+    settings = _stampSettings
+    start = time.time()
+    stamp_report(fn, settings['df'], settings['wmBytes'], settings['maxPages'], settings['stampMode'], lowMemory)
+    if settings['compress']:
+        compress_pdf(fn)
+    return start, time.time()
+
+def stamp_report(fn, df, wmBytes, maxPages, stampMode = 'merge', lowMemory = False):
+    """Adds the student's name and the watermark to a report, lengthening it to maxPages pages.
+
+    stampMode 'merge' merges each report page onto a copy of a watermark page. 'xobject' leaves the report's
+    pages as they are and draws the watermark underneath them as a form XObject (see add_xobject_page).
+
+    Normally the whole report is read and written in one go. With lowMemory, it is written LOW_MEMORY_CHUNK
+    pages at a time, each chunk with a fresh reader so the pages already written can be freed, and the chunks
+    are then joined with mutool.
+    """
+
+    # Find student ID from Canvas filename, then extract name from database
+    studentID = student_id(fn)
+    fullName = student_name(df, studentID)
+    if fullName is None:
+        raise ValueError(f'The student ID {studentID} does not exist.')
+    print('Processing ' + fullName + '…')
+
+    # Make cover page with students name in upper left hand corner
+    # Arial bold seemed to have the best OCR of the fonts readily available to FPDF
+    coverPDF = FPDF('P', 'mm', 'Letter')
+    coverPDF.add_page()            
+    coverPDF.set_font("Arial", style = 'B',size = 16)
+    coverPDF.cell(0, 0, fullName,ln = 1, align = 'L')
+    coverBytes = coverPDF.output(dest = 'S')
+    if isinstance(coverBytes, str):     # Older versions of FPDF return a latin-1 string
+        coverBytes = coverBytes.encode('latin-1')
+
+    # If the report is longer than maxPages, the excess pages are just tacked on the end
+    with open(fn, 'rb') as origReport_file:
+        totalPages = max(maxPages, PdfFileReader(origReport_file, strict = False).getNumPages())
+    chunkSize = LOW_MEMORY_CHUNK if lowMemory else totalPages
+
+    outputName = fn + '_stamped'
+    partNames = []
+    try:
+        for first in range(0, totalPages, chunkSize):
+            partName = outputName if chunkSize == totalPages else f'{fn}_part{len(partNames)}'
+            partNames.append(partName)
+            with open(partName, 'wb') as output_file, open(fn, 'rb') as origReport_file:
+                outReport_writer = PdfFileWriter()
+                add_stamped_pages(outReport_writer,
+                                  PdfFileReader(origReport_file, strict = False),
+                                  PdfFileReader(io.BytesIO(wmBytes)),
+                                  PdfFileReader(io.BytesIO(coverBytes)),
+                                  range(first, min(first + chunkSize, totalPages)), maxPages, stampMode)
+                outReport_writer.write(output_file)
+            del outReport_writer
+
+        if partNames != [outputName]:
+            result = subprocess.run(["mutool", "merge", "-o", outputName] + partNames)
+            if result.returncode != 0:
+                raise RuntimeError(f'mutool could not join the stamped pages of {fn}')
+    except BaseException:
+        # Leave the original report as it was
+        for leftover in partNames + [outputName]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        for partName in partNames:
+            if partName != outputName and os.path.exists(partName):
+                os.remove(partName)
+
+    # Replace the report with the stamped one
+    os.replace(outputName, fn)
+
+def add_stamped_pages(writer, report_reader, wm_reader, cover_reader, pages, maxPages, stampMode):
+    """Adds the given pages (page numbers) of the stamped report to writer. Pages before maxPages get the
+       watermark, and page 0 the cover. Pages after maxPages are copied from the report as they are."""
+    origPages = report_reader.getNumPages()
+    seenImages = {}
+    sharedStreams = {}
+    for i in pages:
+        if i >= maxPages:
+            writer.addPage(report_reader.getPage(i))
+        elif stampMode == 'xobject':
+            add_xobject_page(writer, report_reader, wm_reader, cover_reader, i, seenImages, sharedStreams)
+        else:
+            # Merge the report and the cover page (for page 1) onto the watermark page.
+            pdf_page = wm_reader.getPage(i)
+            if i < origPages:
+                pdf_page.mergePage(report_reader.getPage(i))
+            if i == 0:                            
+                pdf_page.mergePage(cover_reader.getPage(0))
+            writer.addPage(pdf_page)            
+
+def add_xobject_page(writer, report_reader, wm_reader, cover_reader, i, seenImages, sharedStreams):
+    """Adds page i of the report to writer with watermark page i drawn underneath it (and the cover drawn
+       over it if i is 0).
+
+    mergePage decodes the content of every page it touches and writes it back out uncompressed, which is what
+    makes merged reports so much bigger than the originals. Here the watermark page (and the cover) becomes a
+    form XObject that is drawn by a short content stream added before (or after) the report page's own
+    content, so the report's streams are copied as they are. Identical images in the watermark pages are
+    only stored once (seenImages). If the report has no page i, the page is blank apart from the watermark.
+    """
+    wm_page = wm_reader.getPage(i)
+    wmForm = add_object(writer, page_to_form(wm_page, dedupe_images(wm_page['/Resources'], seenImages)))
+    if i < report_reader.getNumPages():
+        page = report_reader.getPage(i)
+    else:
+        page = PageObject.createBlankPage(None, wm_page.mediaBox.getWidth(), wm_page.mediaBox.getHeight())
+
+    # Draw the watermark first, scaled to fill the page, then the report. The report's content is wrapped
+    #   in q/Q so anything it leaves on the graphics state stack cannot affect the cover.
+    box = page.mediaBox
+    before = 'q {:.4f} 0 0 {:.4f} {} {} cm /WmStamp Do Q q '.format(
+                float(box.getWidth()) / float(wm_page.mediaBox.getWidth()),
+                float(box.getHeight()) / float(wm_page.mediaBox.getHeight()),
+                float(box.getLowerLeft_x()), float(box.getLowerLeft_y()))
+    after = 'Q '
+    xobjects = {'/WmStamp': wmForm}
+    if i == 0:
+        cover_page = cover_reader.getPage(0)
+        after += 'q 1 0 0 1 {} {} cm /WmCover Do Q '.format(
+                    float(box.getLowerLeft_x()),
+                    float(box.getUpperRight_y()) - float(cover_page.mediaBox.getHeight()))
+        xobjects['/WmCover'] = add_object(writer, page_to_form(cover_page, cover_page['/Resources']))
+
+    add_page_content(writer, page, before, after, xobjects, sharedStreams)
+    writer.addPage(page)
+
+def page_to_form(page, resources):
+    """Returns a form XObject that draws page, using resources."""
+    content = DecodedStreamObject()
+    content.setData(page.getContents().getData())
+    form = content.flateEncode()      # flateEncode does not keep the stream's dictionary, so fill it in after
+    form.update({NameObject('/Type'): NameObject('/XObject'),
+                 NameObject('/Subtype'): NameObject('/Form'),
+                 NameObject('/BBox'): page.mediaBox,
+                 NameObject('/Resources'): resources})
+    return form
+
+def dedupe_images(resources, seenImages):
+    """Returns a copy of a resource dictionary in which every image that is byte-for-byte identical to one already
+       in seenImages is replaced by a reference to that one. New images are added to seenImages."""
+    if '/XObject' not in resources:
+        return resources
+    xobjects = DictionaryObject()
+    for name, ref in resources['/XObject'].items():   # dict.items gives the references, not the objects
+        image = ref.getObject()
+        if image.get('/Subtype') == '/Image':
+            key = hashlib.sha1(image._data).hexdigest() + repr(sorted((k, repr(v)) for k, v in image.items()))
+            ref = seenImages.setdefault(key, ref)
+        xobjects[name] = ref
+    deduped = DictionaryObject(resources)
+    deduped[NameObject('/XObject')] = xobjects
+    return deduped
+
+def add_page_content(writer, page, before, after, xobjects, sharedStreams):
+    """Surrounds the content of page with the content streams before and after, which draw xobjects.
+       Pages with the same before or after text share one stream (kept in sharedStreams). The page gets its
+       own copy of its resources, as pages of a report often share one."""
+    for text in (before, after):
+        if text not in sharedStreams:
+            sharedStreams[text] = add_object(writer, content_stream(text))
+    contents = ArrayObject()
+    contents.append(sharedStreams[before])
+    if '/Contents' in page:
+        original = dict.__getitem__(page, '/Contents')     # Keep the reference so the stream is copied as is
+        if isinstance(original.getObject(), ArrayObject):
+            contents.extend(original.getObject())
+        else:
+            contents.append(original)
+    contents.append(sharedStreams[after])
+    page[NameObject('/Contents')] = contents
+
+    resources = DictionaryObject(page['/Resources']) if '/Resources' in page else DictionaryObject()
+    pageXObjects = DictionaryObject(resources['/XObject']) if '/XObject' in resources else DictionaryObject()
+    for name, ref in xobjects.items():
+        pageXObjects[NameObject(name)] = ref
+    resources[NameObject('/XObject')] = pageXObjects
+    page[NameObject('/Resources')] = resources
+
+def content_stream(text):
+    stream = DecodedStreamObject()
+    stream.setData(text.encode('latin-1'))
+    return stream
+
+def add_object(writer, obj):
+    """Adds an object to writer and returns a reference to it. (PyPDF2 2.0 renamed _addObject.)"""
+    add = getattr(writer, '_add_object', None) or getattr(writer, '_addObject')
+    return add(obj)
+
+def compress_pdf(fn):
+    """Rewrites a stamped pdf with mutool, merging duplicate objects and streams and compressing any
+       uncompressed streams. If qpdf is installed, objects are then also packed into object streams."""
+    fn_out = fn + '_compressed'
+    result = subprocess.run(["mutool", "clean", "-gggg", "-z", fn, fn_out])
+    if result.returncode == 0:
+        os.replace(fn_out, fn)
+    if shutil.which('qpdf') is not None:
+        result = subprocess.run(["qpdf", "--object-streams=generate", "--compress-streams=y", fn, fn_out])
+        if result.returncode == 0:
+            os.replace(fn_out, fn)
+    if os.path.exists(fn_out):
+        os.remove(fn_out)
+
+# The following function packs the stamped reports in the current directory into a few large pdfs for
+#    Gradescope's bulk upload, with names Bundle_0.pdf, Bundle_1.pdf, etc. Reports are added in file name
+#    order (i.e. by student) and a new bundle is started whenever the next report would take the current
+#    one over maxMB. Each report is copied into its bundle once by mutool, so the bundles are never held
+#    in memory. BundleMap.csv and BundleMap.json record which pages of which bundle belong to each student,
+#    so the submissions can be assigned by a script afterwards.
 #    Unfortunately, merged files confuse Gradescope's processing engine for reasons that I do
-#    understand
-def MergePDFsInDirectory():
-    cnt = 0
-    mergeNum = 0
-    numPerFile = 200
-    mergeName = 'Merge_' + str(mergeNum) + '.pdf'
-    merger = PdfFileMerger()
-    for fn in os.listdir():
-        if fn.endswith('.pdf'):
-            merger.append(fn)
-            cnt += 1
-            if cnt > numPerFile:
-                merger.write(mergeName)
-                merger.close()
-                merger = PdfFileMerger()
-                mergeNum += 1
-                mergeName = 'Merge_' + str(mergeNum) + '.pdf'
-                cnt = 0
-
-    merger.write(mergeName)
-    merger.close()
-        
+#    understand, so this is off unless --bundle-mb is given.
+def MergePDFsInDirectory(df, outFolder, maxMB = 200):
+    os.makedirs(outFolder, exist_ok = True)
+    maxBytes = maxMB * 1e6
+
+    # Decide which reports go in which bundle
+    bundles = []
+    bundleBytes = 0
+    for fn in sorted(fn for fn in os.listdir() if fn.endswith('.pdf')):
+        size = os.path.getsize(fn)
+        if len(bundles) == 0 or (bundleBytes + size > maxBytes and len(bundles[-1]) > 0):
+            bundles.append([])
+            bundleBytes = 0
+        bundles[-1].append(fn)
+        bundleBytes += size
+
+    pageMap = []
+    for bundleNum, files in enumerate(bundles):
+        bundleName = 'Bundle_' + str(bundleNum) + '.pdf'
+        firstPage = 1
+        for fn in files:
+            numPages = count_pages(fn)
+            studentID = student_id(fn)
+            fullName = student_name(df, studentID)
+            pageMap.append({'Bundle': bundleName,
+                            'File': fn,
+                            'ID': studentID,
+                            'Name': fullName.strip() if fullName is not None else '',
+                            'First Page': firstPage,
+                            'Last Page': firstPage + numPages - 1})
+            firstPage += numPages
+
+        print(f'Writing {bundleName} ({len(files)} reports, {firstPage - 1} pages).')
+        result = subprocess.run(["mutool", "merge", "-o", os.path.join(outFolder, bundleName)] + files)
+        if result.returncode != 0:
+            print(f'ERROR: mutool could not write {bundleName}.')
+
+    pageMap_df = pd.DataFrame(pageMap, columns = ['Bundle', 'File', 'ID', 'Name', 'First Page', 'Last Page'])
+    pageMap_df.to_csv(os.path.join(outFolder, 'BundleMap.csv'), index = False)
+    pageMap_df.to_json(os.path.join(outFolder, 'BundleMap.json'), orient = 'records', indent = 2)
+    return pageMap_df
+
 if __name__ == '__main__':
     main()
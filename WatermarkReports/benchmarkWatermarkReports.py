@@ -0,0 +1,123 @@
+# Usage: python benchmarkWatermarkReports.py [--count 200] [--repeat 3] [--docx 0.1 --converter libreoffice]
+#
+# This script measures how fast WatermarkReports.py processes a folder of submissions without needing
+#   real student data. It makes a fake set of submissions with generateFakeSubmissions.py, then runs
+#   the WatermarkReports pipeline on a fresh copy of it --repeat times and reports, for each run,
+#     – the time spent in each stage (busy = summed over threads, wall = first start to last finish)
+#     – the total time and the number of files processed per second
+#     – the peak memory (RSS) of the pipeline and of the programs it runs (mutool, soffice)
+#     – the number of bytes in the submissions folder before and after processing
+#
+#   Each run is done in a fresh process so that the peak memory of one run does not hide the next.
+#   Use --corpus to benchmark an existing folder made by generateFakeSubmissions.py, and --json to save
+#   the results for comparing before and after a change.
+#
+#   This script requires mutool (see WatermarkReports.py) and, if the corpus has Word files, Word or
+#     LibreOffice.
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark WatermarkReports.py on fake submissions')
+    parser.add_argument('--corpus', type = str, help = 'Folder made by generateFakeSubmissions.py (default: make a new one)')
+    parser.add_argument('--count', type = int, default = 200, help = 'Number of fake submissions to make')
+    parser.add_argument('--pages-mean', type = float, default = 8, help = 'Mean number of pages per fake report')
+    parser.add_argument('--scanned', type = float, default = 0.3, help = 'Fraction of fake reports that are scanned')
+    parser.add_argument('--docx', type = float, default = 0.0, help = 'Fraction of fake reports that are Word files')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the fake submissions')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Number of times to run the pipeline')
+    parser.add_argument('--cleaners', type = int, default = os.cpu_count(), help = 'Number of pdfs cleaned at once')
+    parser.add_argument('--converter', choices = ['word', 'libreoffice'], default = 'word',
+                        help = 'Program used to convert .doc/.docx files to pdf')
+    parser.add_argument('--json', type = str, help = 'Save the results to this file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, SCRIPT_DIR)
+    from generateFakeSubmissions import make_submissions
+
+    workFolder = tempfile.mkdtemp(prefix = 'wm_benchmark_')
+    try:
+        corpus = args.corpus
+        if corpus is None:
+            corpus = os.path.join(workFolder, 'corpus')
+            print(f'Making {args.count} fake submissions.')
+            make_submissions(corpus, args.count, args.pages_mean, scannedFraction = args.scanned,
+                             docxFraction = args.docx, seed = args.seed)
+
+        results = []
+        for run in range(args.repeat):
+            runFolder = os.path.join(workFolder, f'run{run}')
+            shutil.copytree(os.path.join(corpus, 'submissions'), os.path.join(runFolder, 'submissions'))
+
+            # Run in a fresh process so ru_maxrss is for this run alone
+            with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(benchmark_run, os.path.join(corpus, 'gradebook.csv'), runFolder,
+                                     args.converter, args.cleaners).result()
+            results.append(result)
+            print_result(run, result)
+            shutil.rmtree(runFolder, ignore_errors = True)
+
+        if args.json:
+            with open(args.json, 'w') as jsonFile:
+                json.dump(results, jsonFile, indent = 2)
+    finally:
+        shutil.rmtree(workFolder, ignore_errors = True)
+
+def benchmark_run(gradesCSV, runFolder, converterName, numCleaners):
+    """Runs the pipeline once on runFolder/submissions. Returns a dictionary of measurements."""
+    sys.path.insert(0, SCRIPT_DIR)
+    from WatermarkReports import prepare_reports
+    from wordConverters import get_converter
+
+    subFolder = os.path.join(runFolder, 'submissions')
+    inFiles = len(os.listdir(subFolder))
+    bytesIn = folder_bytes(subFolder)
+
+    start = time.perf_counter()
+    report = prepare_reports(gradesCSV, subFolder, get_converter(converterName), numCleaners,
+                             wmPath = os.path.join(SCRIPT_DIR, 'Watermark.pdf'),
+                             outlinePath = os.path.join(runFolder, 'Outline.pdf'),
+                             quarantineFolder = os.path.join(runFolder, 'Quarantine'),
+                             reportPath = os.path.join(runFolder, 'RunReport.json'))
+    total = time.perf_counter() - start
+
+    return {'files': inFiles,
+            'seconds': total,
+            'files per second': inFiles / total if total > 0 else 0.0,
+            'stages': report.summary(),
+            'quarantined': len(report.quarantined()),
+            'peak RSS MB': max_rss_mb(resource.RUSAGE_SELF),
+            'peak child RSS MB': max_rss_mb(resource.RUSAGE_CHILDREN),
+            'bytes in': bytesIn,
+            'bytes out': folder_bytes(subFolder)}
+
+def max_rss_mb(who):
+    """Peak resident memory in MB. Linux reports ru_maxrss in kB, macOS in bytes."""
+    maxRSS = resource.getrusage(who).ru_maxrss
+    return maxRSS / (1024 * 1024) if sys.platform == 'darwin' else maxRSS / 1024
+
+def folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, fn)) for fn in os.listdir(folder))
+
+def print_result(run, result):
+    print(f'Run {run}: {result["files"]} files in {result["seconds"]:.2f} s '
+          f'({result["files per second"]:.1f} files/s), '
+          f'peak RSS {result["peak RSS MB"]:.0f} MB (children {result["peak child RSS MB"]:.0f} MB), '
+          f'{result["bytes in"] / 1e6:.1f} MB in, {result["bytes out"] / 1e6:.1f} MB out')
+    for stage, times in result['stages'].items():
+        print(f'    {stage:8s} {times["files"]:5d} files  busy {times["busy"]:7.2f} s  wall {times["wall"]:7.2f} s')
+
+if __name__ == '__main__':
+    main()
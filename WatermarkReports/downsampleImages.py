@@ -0,0 +1,84 @@
+# Downsampling of image-heavy (scanned) reports for WatermarkReports.py
+#
+#   Phone-scanned reports often have a 600 dpi full-color photo on every page, which makes every later step
+#     (cleaning, stamping, uploading to Gradescope) slow. downsample_pdf looks at the images on each page and,
+#     if any is well above the target resolution, rewrites the pdf with Ghostscript so no image is above it.
+#     150 dpi is plenty for grading and for Gradescope's page matching. The student's name is added as text
+#     after this step, so it is not affected.
+#
+#   Reports that are nothing but images (no fonts on any page) are scans, so they are also converted to
+#     grayscale. Reports with typed text keep their colors, as they may have colored graphs.
+#
+#   This requires the installation of Ghostscript, e.g.
+#       brew install ghostscript      or      sudo apt install ghostscript
+
+import os
+import shutil
+import subprocess
+from PyPDF2 import PdfFileReader
+
+# Ghostscript only downsamples images that are more than this factor above the target resolution,
+#   so we use the same threshold to decide whether it is worth running Ghostscript at all.
+DOWNSAMPLE_THRESHOLD = 1.5
+
+def find_gs():
+    """Returns the Ghostscript command, or None if it is not installed."""
+    return shutil.which('gs') or shutil.which('gswin64c')
+
+def scan_images(fn):
+    """Returns the highest image resolution (dpi) on any page of fn and whether every page is just images.
+
+    The resolution of an image is estimated from its size in pixels and the size of the page, which is exact
+    for a full-page scan and an underestimate for smaller images, so small images are left alone.
+    """
+    maxDPI = 0
+    imageOnly = True
+    with open(fn, 'rb') as report_file:
+        reader = PdfFileReader(report_file, strict = False)
+        for page in reader.pages:
+            widthInches = float(page.mediaBox.getWidth()) / 72
+            heightInches = float(page.mediaBox.getHeight()) / 72
+            resources = page['/Resources'] if '/Resources' in page else {}
+            if '/Font' in resources:
+                imageOnly = False
+            xobjects = resources['/XObject'] if '/XObject' in resources else {}
+            for name in xobjects:
+                image = xobjects[name]
+                if image.get('/Subtype') != '/Image':
+                    continue
+                dpi = max(int(image['/Width']) / widthInches, int(image['/Height']) / heightInches)
+                maxDPI = max(maxDPI, dpi)
+    return maxDPI, imageOnly and maxDPI > 0
+
+def downsample_pdf(fn, dpi, keepColor = False, gs = None):
+    """Downsamples the images in fn to dpi, in place, if they are far enough above it. Scans are also made
+       grayscale unless keepColor. Returns (bytesBefore, bytesAfter); the two are equal if nothing was done."""
+    bytesBefore = os.path.getsize(fn)
+    maxDPI, imageOnly = scan_images(fn)
+    if maxDPI <= dpi * DOWNSAMPLE_THRESHOLD:
+        return bytesBefore, bytesBefore
+
+    fn_out = fn + '_downsampled'
+    command = [gs or find_gs(), '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER',
+               '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.5',
+               '-dDownsampleColorImages=true', '-dColorImageDownsampleType=/Bicubic', f'-dColorImageResolution={dpi}',
+               '-dDownsampleGrayImages=true', '-dGrayImageDownsampleType=/Bicubic', f'-dGrayImageResolution={dpi}',
+               '-dDownsampleMonoImages=true', f'-dMonoImageResolution={2 * dpi}',
+               f'-dColorImageDownsampleThreshold={DOWNSAMPLE_THRESHOLD}',
+               f'-dGrayImageDownsampleThreshold={DOWNSAMPLE_THRESHOLD}']
+    if imageOnly and not keepColor:
+        command += ['-sColorConversionStrategy=Gray', '-dProcessColorModel=/DeviceGray']
+    command += [f'-sOutputFile={fn_out}', fn]
+    result = subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+    if result.returncode != 0:
+        if os.path.exists(fn_out):
+            os.remove(fn_out)
+        raise RuntimeError(f'Ghostscript could not downsample {fn}: {result.stderr.strip()}')
+
+    # Ghostscript can occasionally make a file bigger. Keep whichever is smaller.
+    bytesAfter = os.path.getsize(fn_out)
+    if bytesAfter < bytesBefore:
+        os.replace(fn_out, fn)
+        return bytesBefore, bytesAfter
+    os.remove(fn_out)
+    return bytesBefore, bytesBefore
@@ -0,0 +1,173 @@
+# Usage: python generateFakeSubmissions.py outputFolder [--count 200] [--seed 0]
+#
+# This script makes a fake set of lab report submissions so WatermarkReports.py can be tested and
+#   benchmarked without real student data. outputFolder ends up containing
+#     – submissions/     Canvas-style downloads named like smithjane_123456_7891011_Lab_Report.pdf.
+#                          Some are typed pdfs, some are scanned (one grayscale image per page), and
+#                          some are .docx files
+#     – gradebook.csv    A Canvas gradebook with the matching names and IDs. Like the real thing, it has
+#                          a variable number of header rows before the first student
+#
+#   Report lengths are drawn from a normal distribution (--pages-mean, --pages-sd) clipped to between 1 and
+#     --pages-max pages. --scanned and --docx set the fraction of scanned pdfs and Word files.
+
+import argparse
+import os
+import struct
+import tempfile
+import zipfile
+import zlib
+import numpy as np
+from fpdf import FPDF
+
+FIRST_NAMES = ['Ann', 'Bob', 'Charlie', 'Cindy', 'Donna', 'Eli', 'Fatima', 'Grace', 'Hiro', 'Ines',
+               'Jamal', 'Kira', 'Luis', 'Mei', 'Noor', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam']
+LAST_NAMES = ['Smith', 'Jones', 'Garcia', 'Chen', 'Patel', 'Kim', 'Nguyen', 'Okafor', 'Rossi', 'Cohen',
+              'Silva', 'Novak', 'Haddad', 'Ito', 'Brown', 'Lopez', 'Singh', 'Muller', 'Ward', 'Diaz']
+
+SCAN_DPI = 100      # Resolution of the fake scanned pages
+NUM_SCANS = 8       # Number of different scanned page images to choose from
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Make a fake folder of Canvas lab report submissions')
+    parser.add_argument('outFolder', type = str, help = 'Folder to put the submissions and gradebook in')
+    parser.add_argument('--count', type = int, default = 200, help = 'Number of submissions')
+    parser.add_argument('--pages-mean', type = float, default = 8, help = 'Mean number of pages per report')
+    parser.add_argument('--pages-sd', type = float, default = 4, help = 'Standard deviation of the number of pages')
+    parser.add_argument('--pages-max', type = int, default = 40, help = 'Maximum number of pages per report')
+    parser.add_argument('--scanned', type = float, default = 0.3, help = 'Fraction of reports that are scanned')
+    parser.add_argument('--docx', type = float, default = 0.1, help = 'Fraction of reports that are Word files')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the random number generator')
+    args = parser.parse_args()
+
+    make_submissions(args.outFolder, args.count, args.pages_mean, args.pages_sd, args.pages_max,
+                     args.scanned, args.docx, args.seed)
+
+def make_submissions(outFolder, count = 200, pagesMean = 8, pagesSD = 4, pagesMax = 40,
+                     scannedFraction = 0.3, docxFraction = 0.1, seed = 0):
+    """Makes outFolder/submissions and outFolder/gradebook.csv. Returns the paths of the two."""
+
+    rng = np.random.default_rng(seed)
+    subFolder = os.path.join(outFolder, 'submissions')
+    os.makedirs(subFolder, exist_ok = True)
+
+    numPages = np.clip(np.rint(rng.normal(pagesMean, pagesSD, count)), 1, pagesMax).astype(int)
+    kinds = rng.choice(['text', 'scanned', 'docx'], size = count,
+                       p = [1 - scannedFraction - docxFraction, scannedFraction, docxFraction])
+    studentIDs = rng.choice(np.arange(100000, 999999), size = count, replace = False)
+
+    with tempfile.TemporaryDirectory() as scanFolder:
+        scans = make_scans(scanFolder, rng)
+
+        students = []
+        for i in range(count):
+            first = FIRST_NAMES[rng.integers(len(FIRST_NAMES))]
+            last = LAST_NAMES[rng.integers(len(LAST_NAMES))] + str(i)
+            students.append((f'{last}, {first}', int(studentIDs[i])))
+
+            # Canvas names downloads lastfirst_[LATE_]studentID_submissionID_originalName
+            late = '_LATE' if rng.random() < 0.1 else ''
+            base = f'{last.lower()}{first.lower()}{late}_{studentIDs[i]}_{rng.integers(1000000, 9999999)}_Lab_Report'
+            path = os.path.join(subFolder, base)
+            if kinds[i] == 'docx':
+                make_docx(path + '.docx', f'{first} {last}', numPages[i])
+            elif kinds[i] == 'scanned':
+                make_scanned_pdf(path + '.pdf', scans, numPages[i], rng)
+            else:
+                make_text_pdf(path + '.pdf', f'{first} {last}', numPages[i])
+
+    gradebookPath = os.path.join(outFolder, 'gradebook.csv')
+    make_gradebook(gradebookPath, students, rng)
+    return subFolder, gradebookPath
+
+def make_gradebook(path, students, rng):
+    """Writes a Canvas-style gradebook. Student names are quoted; the header rows are not."""
+    headerRows = ['Student,ID,SIS User ID,SIS Login ID,Section,Lab Report (123456)',
+                  '    Manual Posting,,,,,',
+                  '    Points Possible,,,,,100.00']
+    extraRows = rng.integers(1, 3)      # Canvas adds 1 or 2 rows after the column names
+    with open(path, 'w') as gradebook:
+        for row in [headerRows[0]] + headerRows[3 - extraRows:]:
+            gradebook.write(row + '\n')
+        for name, studentID in students:
+            gradebook.write(f'"{name}",{studentID},{studentID + 1000000},netid{studentID},LAB 401,\n')
+
+def make_text_pdf(path, fullName, numPages):
+    """Writes a typed report with a few paragraphs per page."""
+    pdf = FPDF('P', 'mm', 'Letter')
+    pdf.set_font('Arial', size = 11)
+    for page in range(numPages):
+        pdf.add_page()
+        pdf.multi_cell(0, 6, f'Lab Report, {fullName}, page {page + 1}\n\n' + 'The absorbance was measured. ' * 60)
+    pdf.output(path)
+
+def make_scanned_pdf(path, scans, numPages, rng):
+    """Writes a report in which every page is a full-page grayscale image, like a phone scan."""
+    pdf = FPDF('P', 'mm', 'Letter')
+    for page in range(numPages):
+        pdf.add_page()
+        pdf.image(scans[rng.integers(len(scans))], x = 0, y = 0, w = 215.9, h = 279.4)
+    pdf.output(path)
+
+def make_scans(folder, rng):
+    """Writes NUM_SCANS fake scanned pages as png's: off-white noisy paper with dark lines of 'handwriting'."""
+    width, height = int(8.5 * SCAN_DPI), int(11 * SCAN_DPI)
+    scans = []
+    for i in range(NUM_SCANS):
+        image = rng.normal(225, 12, (height, width))
+        for top in range(SCAN_DPI, height - SCAN_DPI, SCAN_DPI // 3):
+            lineLength = rng.integers(width // 3, width - SCAN_DPI)
+            image[top:top + SCAN_DPI // 10, SCAN_DPI // 2:SCAN_DPI // 2 + lineLength] -= rng.normal(150, 20)
+        path = os.path.join(folder, f'scan{i}.png')
+        write_gray_png(path, np.clip(image, 0, 255).astype(np.uint8))
+        scans.append(path)
+    return scans
+
+def write_gray_png(path, image):
+    """Writes a 2D uint8 array as an 8-bit grayscale png."""
+    height, width = image.shape
+    rows = np.hstack([np.zeros((height, 1), dtype = np.uint8), image])     # Filter type 0 on each row
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n')
+        png.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        png.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        png.write(chunk(b'IEND', b''))
+
+def make_docx(path, fullName, numPages):
+    """Writes a minimal Word document with a page break between pages."""
+    paragraph = '<w:p><w:r><w:t>{}</w:t></w:r></w:p>'
+    pageBreak = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+    pages = []
+    for page in range(numPages):
+        text = f'Lab Report, {fullName}, page {page + 1}. ' + 'The absorbance was measured. ' * 40
+        pages.append(paragraph.format(text))
+    body = pageBreak.join(pages)
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>')
+        docx.writestr('_rels/.rels',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/>'
+            '</Relationships>')
+        docx.writestr('word/document.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>')
+
+if __name__ == '__main__':
+    main()
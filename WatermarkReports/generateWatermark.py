@@ -0,0 +1,163 @@
+# Usage: python generateWatermark.py numPages [--outline Outline.pdf]
+#
+# Makes the watermark pages used by WatermarkReports.py for any number of pages, so nobody has to scan
+#   a new Watermark.pdf when a lab report gets longer. Each page has its page number running down the left
+#   and right margins, like the scanned Watermark.pdf.
+#
+#   Gradescope only recognizes the page numbers if they are an image (a scan), not text. So the numbers are
+#     typeset with FPDF, rasterized with mutool, given a light speckle like a scanner would, and saved as a
+#     1-bit image per page, which keeps each page to a few kB.
+#
+#   The pages are cached on disk (by default in ~/.cache/WatermarkReports) keyed by the number of pages and
+#     the style, so after the first run a watermark or outline of any length costs nothing to make. Changing
+#     WATERMARK_STYLE makes a fresh set.
+#
+#   With --outline, the pages are also saved as an Outline.pdf for setting up the assignment in Gradescope.
+#
+#   This script requires the installation of mutool (see WatermarkReports.py).
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import zlib
+import numpy as np
+from fpdf import FPDF
+
+# How the watermark pages look. These defaults match the scanned Watermark.pdf.
+WATERMARK_STYLE = {'font': 'Arial',
+                   'fontSize': 12,      # pt
+                   'rows': 20,          # Copies of the page number down each side
+                   'top': 15,           # mm from the top of the page to the first number
+                   'spacing': 11.5,     # mm between numbers
+                   'margin': 8,         # mm from the edge of the page to the numbers
+                   'dpi': 200,          # Resolution of the page images
+                   'speckle': 0.0005,   # Fraction of the pixels flipped to black, as on a scan
+                   'seed': 0}
+
+CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'WatermarkReports')
+
+PAGE_WIDTH = 215.9     # Letter, in mm
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Make watermark pages with page numbers down both margins')
+    parser.add_argument('numPages', type = int, help = 'Number of pages')
+    parser.add_argument('--outline', type = str, default = 'Outline.pdf', help = 'Save the pages to this file')
+    parser.add_argument('--cache', type = str, default = CACHE_FOLDER, help = 'Folder for the cached watermarks')
+    args = parser.parse_args()
+
+    with open(args.outline, 'wb') as outline_file:
+        outline_file.write(watermark_pdf(args.numPages, cacheFolder = args.cache))
+
+def watermark_pdf(numPages, style = None, cacheFolder = CACHE_FOLDER):
+    """Returns the bytes of a pdf with numPages watermark pages, making and caching it if need be."""
+    style = {**WATERMARK_STYLE, **(style or {})}
+    path = cache_path(numPages, style, cacheFolder)
+    if not os.path.isfile(path):
+        os.makedirs(cacheFolder, exist_ok = True)
+
+        # Several runs may share the cache, so build in a scratch file and move it into place
+        with tempfile.TemporaryDirectory(dir = cacheFolder) as workFolder:
+            tmpPath = os.path.join(workFolder, 'watermark.pdf')
+            make_watermark(tmpPath, numPages, style, workFolder)
+            os.replace(tmpPath, path)
+
+    with open(path, 'rb') as wm_file:
+        return wm_file.read()
+
+def cache_path(numPages, style, cacheFolder):
+    """The cache file for numPages pages in style. The style goes in as a hash of its settings."""
+    styleHash = hashlib.sha256(json.dumps(style, sort_keys = True).encode()).hexdigest()[:12]
+    return os.path.join(cacheFolder, f'Watermark_{numPages}_{styleHash}.pdf')
+
+def make_watermark(path, numPages, style, workFolder):
+    """Writes numPages scan-like watermark pages to path, using workFolder for the intermediate files."""
+
+    # Typeset the numbers
+    textPath = os.path.join(workFolder, 'text.pdf')
+    textPDF = FPDF('P', 'mm', 'Letter')
+    textPDF.set_auto_page_break(False)
+    textPDF.set_font(style['font'], size = style['fontSize'])
+    for page in range(1, numPages + 1):
+        textPDF.add_page()
+        for row in range(style['rows']):
+            y = style['top'] + row * style['spacing']
+            textPDF.text(style['margin'], y, str(page))
+            textPDF.text(PAGE_WIDTH - style['margin'] - textPDF.get_string_width(str(page)), y, str(page))
+    textPDF.output(textPath)
+
+    # Rasterize every page in one go
+    result = subprocess.run(['mutool', 'draw', '-q', '-r', str(style['dpi']), '-c', 'gray',
+                             '-o', os.path.join(workFolder, 'page%d.pgm'), textPath],
+                            stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+    if result.returncode != 0:
+        raise RuntimeError(f'mutool could not rasterize the watermark: {result.stderr.strip()}')
+
+    # Add the speckle and put the images back on full pages
+    rng = np.random.default_rng(style['seed'])
+    images = []
+    for page in range(1, numPages + 1):
+        black = read_pgm(os.path.join(workFolder, f'page{page}.pgm')) < 128
+        black |= rng.random(black.shape) < style['speckle']
+        images.append(black)
+    write_image_pdf(path, images)
+
+def read_pgm(path):
+    """Reads a binary (P5) 8-bit pgm, as written by mutool draw, into a 2D uint8 array."""
+    with open(path, 'rb') as pgm:
+        data = pgm.read()
+    fields = []
+    position = 0
+    while len(fields) < 4:      # Magic number, width, height, maximum value
+        while data[position:position + 1].isspace():
+            position += 1
+        end = position
+        while not data[end:end + 1].isspace():
+            end += 1
+        fields.append(data[position:end])
+        position = end
+    if fields[0] != b'P5':
+        raise ValueError(f'{path} is not a binary pgm')
+    width, height = int(fields[1]), int(fields[2])
+    pixels = np.frombuffer(data, dtype = np.uint8, count = width * height, offset = position + 1)
+    return pixels.reshape(height, width)
+
+def write_image_pdf(path, images):
+    """Writes a pdf with one full Letter page per 2D bool array in images, as a 1-bit image (True is black).
+
+    This is written by hand rather than with FPDF because FPDF gives every page the images of all the pages
+    as resources. Merging a report page onto such a page would copy in every watermark image.
+    """
+    width, height = 612, 792    # Letter, in points
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None]
+    pageRefs = []
+    for black in images:
+        pageNum = len(objects) + 1
+        pageRefs.append(f'{pageNum} 0 R')
+        imageData = zlib.compress(np.packbits(~black, axis = 1).tobytes(), 9)
+        content = f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'.encode()
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] '
+                       f'/Resources << /XObject << /Im0 {pageNum + 2} 0 R >> >> /Contents {pageNum + 1} 0 R >>'.encode())
+        objects.append(f'<< /Length {len(content)} >>\nstream\n'.encode() + content + b'\nendstream')
+        objects.append(f'<< /Type /XObject /Subtype /Image /Width {black.shape[1]} /Height {black.shape[0]} '
+                       f'/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode '
+                       f'/Length {len(imageData)} >>\nstream\n'.encode() + imageData + b'\nendstream')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(pageRefs)}] /Count {len(images)} >>'.encode()
+
+    with open(path, 'wb') as pdf:
+        pdf.write(b'%PDF-1.4\n')
+        offsets = []
+        for num, obj in enumerate(objects, 1):
+            offsets.append(pdf.tell())
+            pdf.write(f'{num} 0 obj\n'.encode() + obj + b'\nendobj\n')
+        xrefStart = pdf.tell()
+        pdf.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode())
+        for offset in offsets:
+            pdf.write(f'{offset:010d} 00000 n \n'.encode())
+        pdf.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xrefStart}\n%%EOF\n'.encode())
+
+if __name__ == '__main__':
+    main()
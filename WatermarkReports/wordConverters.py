@@ -0,0 +1,168 @@
+# Backends used by WatermarkReports.py to convert Word submissions (.doc/.docx) to pdf.
+#
+#   word          Uses docx2pdf, which drives Microsoft Word one file at a time. Only works on a Mac
+#                   or Windows machine with Word installed.
+#   libreoffice   Uses headless LibreOffice (soffice --convert-to pdf). Several soffice processes run
+#                   at once, each with its own user profile because soffice will not share a profile
+#                   between processes. Each process converts a batch of files, which saves most of the
+#                   LibreOffice start-up time. Works on Linux.
+#
+#   Every backend has a convert(files) method that yields (wordFile, pdfFile) pairs as the conversions
+#     finish. pdfFile is None if the conversion failed. The pdf is written next to the Word file, under a
+#     new name (see pdf_name) if a student also handed in a pdf, or another Word file, with the same name.
+#
+#   The LibreOffice backend requires the installation of LibreOffice, e.g.
+#       sudo apt install libreoffice-writer      or      brew install --cask libreoffice
+
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+class Docx2PdfConverter:
+    """Converts Word files one at a time using Microsoft Word (via docx2pdf)."""
+
+    def convert(self, files):
+        from docx2pdf import convert    # pip install docx2pdf. Only needed for this backend.
+
+        for fn in files:
+            pdfName = pdf_name(fn)
+            try:
+                convert(fn, pdfName)
+            except Exception as err:
+                print(f'ERROR: Word could not convert {fn}: {err}')
+                if os.path.isfile(pdfName) and os.path.getsize(pdfName) == 0:
+                    os.remove(pdfName)
+                yield fn, None
+                continue
+            yield fn, pdfName
+
+class LibreOfficeConverter:
+    """Converts Word files with several headless LibreOffice processes running in parallel.
+
+    numProfiles soffice processes run at once, each converting up to batchSize files per invocation.
+    A batch is allowed timeout seconds per file. If a batch runs out of time, the files it did not finish
+    are retried one at a time, so a single file that hangs LibreOffice only costs its own conversion.
+    """
+
+    def __init__(self, numProfiles = 4, batchSize = 10, timeout = 60, soffice = None):
+        self.numProfiles = max(numProfiles, 1)
+        self.batchSize = max(batchSize, 1)
+        self.timeout = timeout
+        self.soffice = soffice or shutil.which('soffice') or shutil.which('libreoffice')
+        if self.soffice is None:
+            raise RuntimeError('Could not find soffice. Is LibreOffice installed?')
+
+    def convert(self, files):
+        files = [os.path.abspath(fn) for fn in files]
+        # soffice names each pdf after its Word file, so x.doc and x.docx go in different batches
+        batches = []
+        for fn in files:
+            stem = os.path.splitext(os.path.basename(fn))[0]
+            batch = next((batch for batch in batches if len(batch) < self.batchSize and
+                          all(os.path.splitext(os.path.basename(other))[0] != stem for other in batch)), None)
+            if batch is None:
+                batches.append([fn])
+            else:
+                batch.append(fn)
+
+        # Each worker thread borrows a profile for the length of one soffice run
+        workDir = tempfile.mkdtemp(prefix = 'soffice_')
+        self._profiles = queue.Queue()
+        for i in range(self.numProfiles):
+            self._profiles.put(os.path.join(workDir, f'profile{i}'))
+
+        try:
+            with ThreadPoolExecutor(max_workers = self.numProfiles) as pool:
+                futures = [pool.submit(self._convert_batch, batch) for batch in batches]
+                for future in as_completed(futures):
+                    for fn, pdfName in future.result():
+                        yield os.path.relpath(fn), pdfName and os.path.relpath(pdfName)
+        finally:
+            shutil.rmtree(workDir, ignore_errors = True)
+
+    def _convert_batch(self, batch):
+        """Converts a batch of files with one soffice process. Returns a list of (wordFile, pdfFile) pairs."""
+        profile = self._profiles.get()
+        try:
+            results = {}
+            timedOut = []
+            finished = self._run_soffice(profile, batch, self.timeout * len(batch), results)
+            if not finished:
+                # Find the file(s) that hung LibreOffice by retrying the rest one at a time
+                for fn in [fn for fn in batch if results.get(fn) is None]:
+                    if not self._run_soffice(profile, [fn], self.timeout, results):
+                        timedOut.append(fn)
+            for fn in batch:
+                if fn in timedOut:
+                    print(f'ERROR: LibreOffice timed out converting {os.path.basename(fn)}')
+                elif results.get(fn) is None:
+                    print(f'ERROR: LibreOffice could not convert {os.path.basename(fn)}')
+            return [(fn, results.get(fn)) for fn in batch]
+        finally:
+            self._profiles.put(profile)
+
+    def _run_soffice(self, profile, files, timeout, results):
+        """Runs soffice on files, recording the pdf for each file that converted in results.
+           Returns False if soffice had to be killed because it ran out of time."""
+
+        # Convert into a scratch folder so a pdf that was already in the submissions folder is never
+        #   mistaken for a successful conversion, then move each pdf next to its Word file.
+        outDir = tempfile.mkdtemp(dir = os.path.dirname(profile))
+        command = [self.soffice,
+                   '-env:UserInstallation=' + Path(profile).as_uri(),
+                   '--headless', '--norestore', '--nolockcheck',
+                   '--convert-to', 'pdf',
+                   '--outdir', outDir] + files
+
+        # soffice starts a child process that does the real work, so run it in its own process group
+        #   and kill the whole group on a timeout. Otherwise the child keeps the profile locked.
+        proc = subprocess.Popen(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+                                start_new_session = True)
+        try:
+            proc.wait(timeout = timeout)
+            finished = True
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            finished = False
+
+        for fn in files:
+            base = os.path.splitext(fn)[0]
+            converted = os.path.join(outDir, os.path.basename(base) + '.pdf')
+            if os.path.isfile(converted) and os.path.getsize(converted) > 0:
+                pdfName = pdf_name(fn)
+                shutil.move(converted, pdfName)
+                results[fn] = pdfName
+        shutil.rmtree(outDir, ignore_errors = True)
+        return finished
+
+def pdf_name(fn):
+    """Returns a name for the pdf of the Word file fn that is not already taken, and creates an empty file
+       with that name so no other conversion can take it. This is fn with .pdf in place of its extension,
+       unless that file exists (e.g. the student handed in both x.docx and x.pdf), in which case the Word
+       extension is kept, e.g. x_docx.pdf, with a number added if needed."""
+    base, extension = os.path.splitext(fn)
+    candidates = [base + '.pdf', f'{base}_{extension[1:]}.pdf']
+    i = 2
+    while True:
+        for candidate in candidates:
+            try:
+                os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return candidate
+            except FileExistsError:
+                pass
+        candidates = [f'{base}_{extension[1:]}{i}.pdf']
+        i += 1
+
+def get_converter(name, numProfiles = 4, batchSize = 10, timeout = 60):
+    """Returns the conversion backend called name ('word' or 'libreoffice')."""
+    if name == 'word':
+        return Docx2PdfConverter()
+    if name == 'libreoffice':
+        return LibreOfficeConverter(numProfiles, batchSize, timeout)
+    raise ValueError(f'Unknown Word converter {name}')